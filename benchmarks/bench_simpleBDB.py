@@ -0,0 +1,346 @@
+"""Throughput benchmarks for the core Resource, Cursor and PandasDf paths
+
+Each benchmark runs once per dataset size, in one env in a temporary directory shared by
+every run, with the tables it uses truncated first. Reports operations per second.
+Metrics are only collected for the contention benchmark, where they count the deadlock
+retries, so the other timings don't include the instrumentation. Results are written as
+json, and can be compared against a saved run to catch regressions.
+
+    python benchmarks/bench_simpleBDB.py --sizes 1000 10000 --output baseline.json
+    python benchmarks/bench_simpleBDB.py --sizes 1000 10000 --compare baseline.json
+"""
+import argparse
+import json
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import pandas as pd
+import simpleBDB as db
+
+
+class BenchResource(db.Resource):
+    keys = ("First", "Second")
+
+
+class BenchOrdered(db.Resource):
+    keys = ("First", "Second")
+    keyCodec = db.TupleKeyCodec
+
+
+class BenchContainer(db.Container):
+    keys = ("First",)
+
+    def add_item(self, toAdd):
+        toAdd.append(self.item)
+        return toAdd
+
+    def remove_item(self, toRemove):
+        toRemove.remove(self.item)
+        self.removed = self.item
+        return toRemove
+
+    def make_details(self):
+        return []
+
+
+class BenchPandas(db.PandasDf):
+    keys = ("First",)
+    merge_keys = ('id',)
+
+    def make_details(self):
+        return pd.DataFrame()
+
+
+BENCHMARKS = []
+
+# Keys are spread over this many values of the first key entry
+GROUPS = 100
+
+
+def benchmark(name, withMetrics=False):
+    """Registers func(size) -> (operations, seconds) as a benchmark
+
+    withMetrics runs it with the metrics enabled, which slows every operation down"""
+    def decorator(func):
+        BENCHMARKS.append((name, func, withMetrics))
+        return func
+
+    return decorator
+
+
+def clear(resource):
+    txn = db.getEnvTxn()
+    resource.db.truncate(txn=txn)
+    txn.commit()
+
+
+def keyTuples(size):
+    return [(str(i % GROUPS), str(i)) for i in range(size)]
+
+
+def load(resource, size):
+    clear(resource)
+    resource.put_many((key, {'value': key[1]}) for key in keyTuples(size))
+
+
+@benchmark('point_put')
+def pointPut(size):
+    clear(BenchResource)
+    keys = keyTuples(size)
+    start = time.perf_counter()
+    for key in keys:
+        BenchResource(*key).put({'value': key[1]})
+    return size, time.perf_counter() - start
+
+
+@benchmark('put_many')
+def putMany(size):
+    clear(BenchResource)
+    items = [(key, {'value': key[1]}) for key in keyTuples(size)]
+    start = time.perf_counter()
+    BenchResource.put_many(items)
+    return size, time.perf_counter() - start
+
+
+@benchmark('point_get')
+def pointGet(size):
+    load(BenchResource, size)
+    keys = keyTuples(size)
+    random.Random(size).shuffle(keys)
+    start = time.perf_counter()
+    for key in keys:
+        BenchResource(*key).get()
+    return size, time.perf_counter() - start
+
+
+@benchmark('all')
+def allItems(size):
+    load(BenchResource, size)
+    start = time.perf_counter()
+    BenchResource.all()
+    return size, time.perf_counter() - start
+
+
+def keysWhichMatch(resource, size):
+    load(resource, size)
+    start = time.perf_counter()
+    for group in range(GROUPS):
+        resource.keysWhichMatch(str(group))
+    return GROUPS, time.perf_counter() - start
+
+
+@benchmark('keys_which_match')
+def keysWhichMatchPickled(size):
+    return keysWhichMatch(BenchResource, size)
+
+
+@benchmark('keys_which_match_ordered')
+def keysWhichMatchOrdered(size):
+    return keysWhichMatch(BenchOrdered, size)
+
+
+def cursorScan(size, bulk):
+    load(BenchResource, size)
+    txn = db.getEnvTxn()
+    start = time.perf_counter()
+    cursor = BenchResource.getCursor(txn=txn, bulk=bulk)
+    current = cursor.next()
+    while current is not None:
+        current = cursor.next()
+    cursor.close()
+    elapsed = time.perf_counter() - start
+    txn.commit()
+    return size, elapsed
+
+
+@benchmark('cursor_scan')
+def cursorScanPlain(size):
+    return cursorScan(size, False)
+
+
+@benchmark('cursor_scan_bulk')
+def cursorScanBulk(size):
+    return cursorScan(size, True)
+
+
+@benchmark('cursor_batches')
+def cursorBatches(size):
+    load(BenchResource, size)
+    txn = db.getEnvTxn()
+    start = time.perf_counter()
+    cursor = BenchResource.getCursor(txn=txn, bulk=True)
+    for batch in cursor.iter_batches():
+        pass
+    cursor.close()
+    elapsed = time.perf_counter() - start
+    txn.commit()
+    return size, elapsed
+
+
+@benchmark('container_add')
+def containerAdd(size):
+    """Adds to one container, so every add works on a larger value"""
+    clear(BenchContainer)
+    container = BenchContainer('bench')
+    start = time.perf_counter()
+    for i in range(size):
+        txn = db.getEnvTxn()
+        container.add(i, txn=txn)
+        txn.commit()
+    return size, time.perf_counter() - start
+
+
+@benchmark('pandas_add')
+def pandasAdd(size):
+    """Adds one row at a time to a frame which grows to size rows"""
+    clear(BenchPandas)
+    frame = BenchPandas('bench')
+    rows = [pd.DataFrame({'id': [i], 'value': [str(i)]}) for i in range(size)]
+    start = time.perf_counter()
+    for row in rows:
+        txn = db.getEnvTxn()
+        frame.add(row, txn=txn)
+        txn.commit()
+    return size, time.perf_counter() - start
+
+
+@benchmark('contention', withMetrics=True)
+def contention(size, threads=4, hotKeys=4):
+    """Threads incrementing a few hot keys, with deadlocks broken by a detector thread"""
+    clear(BenchResource)
+    for key in range(hotKeys):
+        BenchResource('hot', str(key)).put(0)
+
+    perThread = max(1, size // threads)
+
+    @db.retry
+    @db.txnAbortOnError
+    def increment(first, second, txn=None):
+        # Taking two keys in random order is what makes the deadlocks
+        BenchResource('hot', first).alter(lambda value: value + 1, txn=txn)
+        BenchResource('hot', second).alter(lambda value: value + 1, txn=txn)
+
+    def work(seed):
+        rand = random.Random(seed)
+        for i in range(perThread):
+            first, second = rand.sample(range(hotKeys), 2)
+            increment(str(first), str(second))
+
+    running = True
+
+    def detect():
+        while running:
+            db.lockDetect()
+            time.sleep(0.01)
+
+    detector = threading.Thread(target=detect)
+    detector.start()
+    workers = [threading.Thread(target=work, args=(seed,)) for seed in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    running = False
+    detector.join()
+    return perThread * threads, elapsed
+
+
+def run(sizes, only=None, repeat=1):
+    results = []
+    for name, func, withMetrics in BENCHMARKS:
+        if only and name not in only:
+            continue
+        for size in sizes:
+            best = None
+            for attempt in range(repeat):
+                if withMetrics:
+                    db.metrics.reset()
+                    db.enableMetrics()
+                try:
+                    operations, seconds = func(size)
+                finally:
+                    if withMetrics:
+                        db.enableMetrics(False)
+                if best is None or seconds < best['seconds']:
+                    best = {'name': name,
+                            'size': size,
+                            'operations': operations,
+                            'seconds': seconds,
+                            'opsPerSec': operations / seconds if seconds else float('inf')}
+                    if withMetrics:
+                        best['deadlockRetries'] = db.metrics.snapshot()['counters'].get('deadlock.retries', 0)
+            print('%-26s %8d %12.1f ops/s' % (name, size, best['opsPerSec']))
+            results.append(best)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Prints the change of each result against the baseline, returns the regressions"""
+    previous = {(result['name'], result['size']): result for result in baseline['results']}
+    regressions = []
+    print('\n%-26s %8s %12s %12s %8s' % ('benchmark', 'size', 'baseline', 'current', 'change'))
+    for result in results:
+        old = previous.get((result['name'], result['size']))
+        if old is None:
+            continue
+        change = result['opsPerSec'] / old['opsPerSec'] - 1
+        flag = ''
+        if change < -threshold:
+            regressions.append(result)
+            flag = ' REGRESSION'
+        print('%-26s %8d %12.1f %12.1f %+7.1f%%%s' % (
+            result['name'], result['size'], old['opsPerSec'], result['opsPerSec'], change * 100, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--only', nargs='+', help='names of the benchmarks to run')
+    parser.add_argument('--repeat', type=int, default=1, help='keep the best of this many runs')
+    parser.add_argument('--output', help='write the results to this json file')
+    parser.add_argument('--compare', help='json file of a previous run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown which counts as a regression, 0.1 is 10%%')
+    args = parser.parse_args(argv)
+
+    random.seed(0)
+    envPath = tempfile.mkdtemp(prefix='simpleBDB-bench-')
+    db.open_env()
+    db.createEnvWithDir(envPath)
+    db.open_dbs()
+
+    try:
+        results = run(args.sizes, only=args.only, repeat=args.repeat)
+    finally:
+        db.close_dbs()
+        db.close_env()
+        shutil.rmtree(envPath)
+
+    output = {'meta': {'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'sizes': args.sizes},
+              'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,18 @@
+import asyncio
+import copy
+import functools
+import itertools
 import json
+import lzma
 import pickle
 import os
 import logging
-import pandas as pd
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 # third party module not by me:
 import berkeleydb.db as db
 from berkeleydb.dbutils import DeadlockWrap
@@ -13,48 +23,210 @@ DBS = []
 
 env = None
 
+# Set by open_dbs(lazy=True), each Resource then opens on the first use of its db
+lazyOpen = False
+openLock = threading.RLock()
+# The handles setDB is opening in this thread, before they are set on their class
+opening = threading.local()
+
+# pandas and numpy are slow to import, importPandas sets these once a PandasDf subclass is defined
+np = None
+pd = None
+
+
+def importPandas():
+    global np, pd
+    if pd is None:
+        import numpy
+        import pandas
+        np = numpy
+        pd = pandas
+
+
+class Metrics:
+    """Counters and latency histograms, only collected while enabled is set
+
+    Listeners are called with (kind, name, value) for every count and observation,
+    so they can forward them to a metrics exporter. snapshot returns everything so far."""
+    # Upper bounds in seconds of the latency histogram buckets
+    buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self):
+        self.enabled = False
+        self.counters = {}
+        self.histograms = {}
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        for listener in self.listeners:
+            listener('count', name, value)
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = {'count': 0, 'sum': 0.0, 'max': 0.0,
+                                                     'buckets': [0] * (len(self.buckets) + 1)}
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+            histogram['max'] = max(histogram['max'], seconds)
+            index = 0
+            while index < len(self.buckets) and seconds > self.buckets[index]:
+                index += 1
+            histogram['buckets'][index] += 1
+        for listener in self.listeners:
+            listener('observe', name, seconds)
+
+    def addListener(self, listener):
+        self.listeners.append(listener)
+
+    def removeListener(self, listener):
+        self.listeners.remove(listener)
+
+    def snapshot(self):
+        with self.lock:
+            return {'counters': dict(self.counters),
+                    'histograms': {name: dict(histogram, buckets=list(histogram['buckets']))
+                                   for name, histogram in self.histograms.items()},
+                    'bucketBounds': list(self.buckets)}
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+
+metrics = Metrics()
+
+
+def enableMetrics(enabled=True):
+    metrics.enabled = enabled
+
+
+def metricOwner(obj):
+    if isinstance(obj, type):
+        return obj.__name__
+    if isinstance(obj, Cursor):
+        return obj.parent.__name__
+    return type(obj).__name__
+
+
+def instrumented(operation):
+    """Times the wrapped method as "<resource name>.<operation>" while metrics are enabled"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrap(self, *args, **kwargs):
+            if not metrics.enabled:
+                return func(self, *args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                metrics.observe('%s.%s' % (metricOwner(self), operation), time.perf_counter() - start)
+
+        return wrap
+
+    return decorator
+
+
+def countDeadlocks(func):
+    def wrap(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except db.DBLockDeadlockError:
+            if metrics.enabled:
+                metrics.count('deadlock.retries')
+            raise
+
+    return wrap
+
 
 def retry(func):
     """Wrapper function to retry database operations"""
     def wrap(*args, **kwargs):
-        return DeadlockWrap(func, *args, **kwargs, max_retries=50)
+        return DeadlockWrap(countDeadlocks(func), *args, **kwargs, max_retries=50)
 
     return wrap
 
 
-def txnAbortOnError(func):
-    """Wrapper function to provide, and abort a txn when an error occurs"""
+def txnAbortOnError(func=None, durability=None):
+    """Wrapper function to provide, and abort a txn when an error occurs
+
+    Use as @txnAbortOnError(durability='nosync') to commit with one of the TXN_DURABILITY levels"""
+    if func is None:
+        return functools.partial(txnAbortOnError, durability=durability)
+
     def wrap(*args, **kwargs):
-        txn = getEnvTxn()
+        txn = getEnvTxn(durability=durability)
         try:
             out = func(*args, **kwargs, txn=txn)
-            txn.commit()
+            commitTxn(txn, durability=durability)
             return out
         except AbortTXNException:
             txn.abort()
+            if metrics.enabled:
+                metrics.count('txn.abort')
             return
         except:
             logging.exception('error occured in func')
             txn.abort()
+            if metrics.enabled:
+                metrics.count('txn.abort')
             raise
 
     return wrap
 
 
+def runChunked(func, records, txn=None, chunk=10000, durability=None):
+    """Calls func(records, txn=txn) on each chunk of records and joins the outputs
+
+    When a txn is passed everything runs inside of it, and deadlocks are left to the caller.
+    Otherwise each chunk is committed in its own txn with durability, retried on deadlock."""
+    if txn is not None:
+        return func(records, txn=txn)
+
+    output = []
+    for start in range(0, len(records), chunk):
+        output.extend(retry(txnAbortOnError(func, durability=durability))(records[start:start + chunk]))
+    return output
+
+
 # this prevents lockers/locks from accumulating when python is closed
 # normally, but does not prevent this when we C-c out of the server.
 def close_dbs():
-    """Closes the DB's when the system is closed with C-c"""
+    """Closes the DB's when the system is closed with C-c
+
+    Any maintenance thread is stopped first, as its compact works on the open DB's"""
+    global lazyOpen
+    stopMaintenance()
+    lazyOpen = False
     for dbToClose in DBS:
-        dbToClose.close()
+        if dbToClose.isOpen():
+            dbToClose.close()
 
 
-def open_dbs():
+def open_dbs(lazy=False):
+    """Opens every Resource, or with lazy each one the first time it is used"""
+    global lazyOpen
+    if lazy:
+        lazyOpen = True
+        return
     for dbToOpen in DBS:
         dbToOpen.setDB()
 
 
+def prewarm(resources=None):
+    """Opens resources, every Resource when None, which haven't been opened yet"""
+    for resource in DBS if resources is None else resources:
+        resource.openOnce()
+
+
 def close_env():
+    stopMaintenance()
+    disableGroupCommit()
     env.close()
 
 
@@ -80,13 +252,227 @@ def getLogArchive(flags=0):
     return env.log_archive(flags)
 
 
-def getEnvTxn(parent=None, flags=0):
+def stats():
+    """Returns the collected metrics, read cache stats, and the env's subsystem statistics"""
+    output = {'metrics': metrics.snapshot(),
+              'caches': {resource.__name__: resource.cache.stats()
+                         for resource in DBS if resource.cache is not None}}
+
+    if env is not None:
+        memp = env.memp_stat()
+        # The per file statistics come back alongside the totals
+        if isinstance(memp, tuple):
+            memp, files = memp
+            output['mempFiles'] = files
+        output['memp'] = memp
+        output['lock'] = env.lock_stat()
+        output['log'] = env.log_stat()
+        output['txn'] = env.txn_stat()
+
+    if groupCommit is not None:
+        output['groupCommit'] = groupCommit.stats()
+
+    if maintenance is not None:
+        output['maintenance'] = maintenance.stats()
+
+    return output
+
+
+def getEnvTxn(parent=None, flags=0, durability=None):
+    """Begins a txn, durability is one of TXN_DURABILITY, None uses the env's setting
+
+    Commit a txn begun with durability='group' with commitTxn(txn, 'group')"""
     if env is None:
         raise EnvNotCreatedException
     else:
+        if durability is not None:
+            flags = flags | TXN_DURABILITY[durability]
         return env.txn_begin(parent=parent, flags=flags)
 
 
+def commitTxn(txn, durability=None):
+    """Commits txn, 'group' waits for the group commit flush instead of flushing the log itself"""
+    if durability == 'group':
+        getGroupCommit().commit(txn)
+    else:
+        txn.commit()
+    if metrics.enabled:
+        metrics.count('txn.commit')
+
+
+def snapshot_txn(parent=None):
+    """Begins a txn which reads the data as it was when the txn began
+
+    Reads of multiversion files in it take no read locks, so long scans neither wait on
+    nor deadlock with writers. Files opened without multiversion are read with locks as usual.
+    Writers copy the pages they change while a snapshot is open, so it needs a larger cache."""
+    return getEnvTxn(parent=parent, flags=db.DB_TXN_SNAPSHOT)
+
+
+def snapshotRead(func):
+    """Wrapper which lets func take snapshot=True to read in its own snapshot_txn
+
+    Ignored when a txn is passed, the txn decides how the reads are done"""
+    @functools.wraps(func)
+    def wrap(self, txn=None, *args, snapshot=False, **kwargs):
+        if not snapshot or txn is not None:
+            return func(self, txn, *args, **kwargs)
+        txn = snapshot_txn()
+        try:
+            out = func(self, txn, *args, **kwargs)
+        except:
+            txn.abort()
+            raise
+        txn.commit()
+        return out
+
+    return wrap
+
+
+def copyRecords(source, target, convertKey=None, chunk=10000):
+    """Puts every record of the source DB into target, passing the keys through convertKey
+
+    Returns the number of records copied"""
+    count = 0
+    cursor = source.cursor()
+    txn = getEnvTxn()
+    try:
+        record = cursor.first()
+        while record is not None:
+            key, value = record
+            if convertKey is not None:
+                key = convertKey(key)
+            target.put(key, value, txn=txn)
+            count += 1
+            # Keep each txn small enough to fit in the lock table
+            if count % chunk == 0:
+                txn.commit()
+                txn = getEnvTxn()
+            record = cursor.next()
+        txn.commit()
+    except:
+        txn.abort()
+        raise
+    finally:
+        cursor.close()
+    return count
+
+
+def migrateKeyCodec(resource, oldCodec=None, chunk=10000):
+    """Rewrites every key of resource from oldCodec into resource.keyCodec
+
+    Set keyCodec on the class before calling this. The records are copied into a
+    temporary file which then replaces the original, so nothing else should write
+    to the resource while this runs. Returns the number of records migrated."""
+    if env is None:
+        raise EnvNotCreatedException
+    if resource.db is None:
+        raise DBNeverOpenedException
+    if oldCodec is None:
+        oldCodec = PickleKeyCodec
+
+    tempName = resource.filename + '.migrate'
+    try:
+        env.dbremove(tempName, flags=db.DB_AUTO_COMMIT)
+    except db.DBNoSuchFileError:
+        pass
+
+    newDb = db.DB(env)
+    newDb.open(tempName, None, resource.DBTYPE,
+               db.DB_AUTO_COMMIT |
+               db.DB_CREATE)
+
+    def convertKey(key):
+        return resource.keyCodec.encode(oldCodec.decode(key))
+
+    try:
+        count = copyRecords(resource.db, newDb, convertKey, chunk=chunk)
+    finally:
+        newDb.close()
+
+    # Pending deltas are moved to the new keys as well
+    deltaName = resource.filename + '.deltas'
+    deltaTempName = None
+    if getattr(resource, 'deltaDb', None) is not None:
+        deltaTempName = deltaName + '.migrate'
+        try:
+            env.dbremove(deltaTempName, flags=db.DB_AUTO_COMMIT)
+        except db.DBNoSuchFileError:
+            pass
+        newDeltas = db.DB(env)
+        newDeltas.set_flags(db.DB_DUP)
+        newDeltas.open(deltaTempName, None, db.DB_BTREE,
+                       db.DB_AUTO_COMMIT |
+                       db.DB_CREATE)
+        try:
+            copyRecords(resource.deltaDb, newDeltas, convertKey, chunk=chunk)
+        finally:
+            newDeltas.close()
+
+    resource.close()
+    if resource.cache is not None:
+        resource.cache.clear()
+    # Indexes point at the old keys, setDB builds them again
+    for name in resource.indexes:
+        env.dbremove(resource.indexFilename(name), flags=db.DB_AUTO_COMMIT)
+    env.dbremove(resource.filename, flags=db.DB_AUTO_COMMIT)
+    env.dbrename(tempName, None, resource.filename, flags=db.DB_AUTO_COMMIT)
+    if deltaTempName is not None:
+        env.dbremove(deltaName, flags=db.DB_AUTO_COMMIT)
+        env.dbrename(deltaTempName, None, deltaName, flags=db.DB_AUTO_COMMIT)
+    resource.setDB()
+
+    return count
+
+
+def convertAccessMethod(resource, chunk=10000):
+    """Rewrites the file of resource with the access method and settings the class has now
+
+    To move a table between DB_BTREE and DB_HASH, change DBTYPE and settings such as
+    hashFillFactor or pageSize on the class, then call this before using it. The existing
+    file is read with whichever access method made it, and its records are copied into a
+    temporary file which then replaces it, so nothing else should use the resource while
+    this runs. Keys and values are copied as they are, so index and delta files stay valid.
+    Returns the number of records copied."""
+    if env is None:
+        raise EnvNotCreatedException
+    if resource.DBTYPE == db.DB_QUEUE:
+        raise ValueError('Queues are keyed by record number, so other files can not become one')
+
+    if resource.isOpen():
+        resource.close()
+    if resource.cache is not None:
+        resource.cache.clear()
+
+    tempName = resource.filename + '.convert'
+    try:
+        env.dbremove(tempName, flags=db.DB_AUTO_COMMIT)
+    except db.DBNoSuchFileError:
+        pass
+
+    oldDb = db.DB(env)
+    oldDb.open(resource.filename, None, db.DB_UNKNOWN, db.DB_AUTO_COMMIT)
+    newDb = db.DB(env)
+    if resource.pageSize is not None:
+        newDb.set_pagesize(resource.pageSize)
+    resource.configureDb(newDb)
+    newDb.open(tempName, None, resource.DBTYPE,
+               db.DB_AUTO_COMMIT |
+               db.DB_CREATE)
+
+    try:
+        count = copyRecords(oldDb, newDb, chunk=chunk)
+    finally:
+        oldDb.close()
+        newDb.close()
+
+    env.dbremove(resource.filename, flags=db.DB_AUTO_COMMIT)
+    env.dbrename(tempName, None, resource.filename, flags=db.DB_AUTO_COMMIT)
+    resource.setDB()
+
+    return count
+
+
 class EnvNotCreatedException(Exception):
     pass
 
@@ -99,6 +485,463 @@ class AbortTXNException(Exception):
     pass
 
 
+class PickleKeyCodec:
+    """Legacy key format, keys are stored as pickled tuples
+
+    The stored bytes do not sort in key order, so prefix lookups have to scan every key"""
+    ordered = False
+
+    @staticmethod
+    def encode(key):
+        return pickle.dumps(key, 1)
+
+    @staticmethod
+    def decode(stored):
+        return pickle.loads(stored)
+
+
+class TupleKeyCodec:
+    """Order preserving key format for tuples of str's
+
+    Each entry is stored as utf-8 followed by a null byte, with null bytes inside an entry
+    escaped as null followed by 0xff. The BTree then sorts records in key tuple order,
+    and every key starting with a partial key tuple lies in one contiguous range."""
+    ordered = True
+
+    @staticmethod
+    def encode(key):
+        return b''.join(str(entry).encode('utf-8').replace(b'\x00', b'\x00\xff') + b'\x00'
+                        for entry in key)
+
+    @staticmethod
+    def decode(stored):
+        entries = []
+        # The trailing terminator always leaves an empty last part
+        for part in stored.split(b'\x00')[:-1]:
+            # A part can only start with 0xff when the null before it was escaped
+            if part[:1] == b'\xff' and entries:
+                entries[-1] += b'\x00' + part[1:]
+            else:
+                entries.append(part)
+        return tuple(entry.decode('utf-8') for entry in entries)
+
+    @classmethod
+    def prefixRange(cls, partial):
+        """Returns the (start, end) byte range holding every key which starts with partial
+
+        end is None when partial is empty"""
+        start = cls.encode(partial)
+        if not start:
+            return start, None
+        # utf-8 never produces 0xff, so only escaped nulls sort past the prefix
+        return start, start + b'\xff'
+
+
+# Value header bytes, none of these are pickle opcodes so headerless records still decode
+PICKLE_HEADER = b'\x01'
+OUT_OF_BAND_HEADER = b'\x02'
+ZLIB_HEADER = b'\x03'
+LZMA_HEADER = b'\x04'
+JSON_HEADER = b'\x05'
+BYTES_HEADER = b'\x06'
+COLUMNS_HEADER = b'\x07'
+
+valueDecoders = {}
+
+
+def registerValueDecoder(header, decoder):
+    """Registers decoder for stored values which start with the header byte"""
+    valueDecoders[header] = decoder
+
+
+def decodeValue(stored):
+    """Decodes a stored value using the decoder registered for its header byte"""
+    decoder = valueDecoders.get(stored[:1])
+    if decoder is None:
+        # Records written before value codecs existed are protocol 1 pickles with no header
+        return pickle.loads(stored)
+    return decoder(stored)
+
+
+class PickleCodec:
+    """Pickles values, large buffers such as numpy arrays can be stored out of band
+
+    Out of band buffers are kept next to the pickle instead of being copied into it"""
+
+    def __init__(self, protocol=pickle.HIGHEST_PROTOCOL, outOfBand=False):
+        if outOfBand and protocol < 5:
+            raise ValueError('Out of band buffers require pickle protocol 5 or higher')
+        self.protocol = protocol
+        self.outOfBand = outOfBand
+
+    def encode(self, data):
+        if not self.outOfBand:
+            return PICKLE_HEADER + pickle.dumps(data, self.protocol)
+
+        buffers = []
+        main = pickle.dumps(data, self.protocol, buffer_callback=buffers.append)
+        raws = [buffer.raw() for buffer in buffers]
+        lengths = [len(main)] + [raw.nbytes for raw in raws]
+        layout = struct.pack('<I%dQ' % len(lengths), len(raws), *lengths)
+        return b''.join([OUT_OF_BAND_HEADER, layout, main] + raws)
+
+    @staticmethod
+    def decode(stored):
+        return pickle.loads(memoryview(stored)[1:])
+
+    @staticmethod
+    def decodeOutOfBand(stored):
+        # Copy once into a bytearray so the arrays built on top of it are writable
+        data = memoryview(bytearray(stored))
+        count, = struct.unpack_from('<I', data, 1)
+        lengths = struct.unpack_from('<%dQ' % (count + 1), data, 5)
+        offset = 5 + 8 * (count + 1)
+        parts = []
+        for length in lengths:
+            parts.append(data[offset:offset + length])
+            offset += length
+        return pickle.loads(parts[0], buffers=parts[1:])
+
+
+class CompressedCodec:
+    """Compresses the output of another codec once it reaches threshold bytes"""
+    header = None
+
+    def __init__(self, codec=None, threshold=4096):
+        if codec is None:
+            codec = PickleCodec()
+        self.codec = codec
+        self.threshold = threshold
+
+    def encode(self, data):
+        stored = self.codec.encode(data)
+        if len(stored) < self.threshold:
+            return stored
+        return self.header + self.compress(stored)
+
+    @classmethod
+    def decode(cls, stored):
+        return decodeValue(cls.decompress(memoryview(stored)[1:]))
+
+
+class ZlibCodec(CompressedCodec):
+    header = ZLIB_HEADER
+
+    def __init__(self, codec=None, threshold=4096, level=6):
+        super().__init__(codec=codec, threshold=threshold)
+        self.level = level
+
+    def compress(self, stored):
+        return zlib.compress(stored, self.level)
+
+    @staticmethod
+    def decompress(stored):
+        return zlib.decompress(stored)
+
+
+class LzmaCodec(CompressedCodec):
+    header = LZMA_HEADER
+
+    def __init__(self, codec=None, threshold=4096, preset=6):
+        super().__init__(codec=codec, threshold=threshold)
+        self.preset = preset
+
+    def compress(self, stored):
+        return lzma.compress(stored, preset=self.preset)
+
+    @staticmethod
+    def decompress(stored):
+        return lzma.decompress(stored)
+
+
+class JsonCodec:
+    """Stores simple types such as dicts, lists, str's and numbers as json"""
+
+    def encode(self, data):
+        return JSON_HEADER + json.dumps(data).encode('utf-8')
+
+    @staticmethod
+    def decode(stored):
+        return json.loads(bytes(stored[1:]))
+
+
+class BytesCodec:
+    """Stores bytes as they are after the header, so Resource.get_range can read part of them"""
+
+    def encode(self, data):
+        return b''.join((BYTES_HEADER, data))
+
+    @staticmethod
+    def decode(stored):
+        return bytes(stored[1:])
+
+
+class ColumnarCodec:
+    """Stores DataFrames a column at a time, so PandasDf.get_columns can read only some of them
+
+    The index and each column are encoded with codec, after a directory of their lengths.
+    Values which aren't DataFrames are stored by codec as they are."""
+
+    def __init__(self, codec=None):
+        importPandas()
+        if codec is None:
+            codec = PickleCodec()
+        self.codec = codec
+
+    def encode(self, data):
+        if not isinstance(data, pd.DataFrame):
+            return self.codec.encode(data)
+
+        parts = [self.codec.encode(data.index)]
+        for position in range(len(data.columns)):
+            parts.append(self.codec.encode(data.iloc[:, position].reset_index(drop=True)))
+        directory = pickle.dumps((data.columns, [len(part) for part in parts]), pickle.HIGHEST_PROTOCOL)
+        return b''.join([COLUMNS_HEADER, struct.pack('<I', len(directory)), directory] + parts)
+
+    @staticmethod
+    def decodeColumns(read, columns=None):
+        """Decodes the columns named in columns, all of them when None
+
+        read(offset, length) returns that range of the stored value, so only the
+        directory and the parts which are needed get read"""
+        importPandas()
+        size, = struct.unpack('<I', read(1, 4))
+        names, lengths = pickle.loads(read(5, size))
+        ranges = []
+        offset = 5 + size
+        for length in lengths:
+            ranges.append((offset, length))
+            offset += length
+
+        if columns is None:
+            positions = list(range(len(names)))
+        else:
+            positions = []
+            for column in columns:
+                found = [position for position, name in enumerate(names) if name == column]
+                if not found:
+                    raise KeyError(column)
+                positions.extend(found)
+
+        index = decodeValue(read(*ranges[0]))
+        series = [decodeValue(read(*ranges[position + 1])) for position in positions]
+        if series:
+            output = pd.concat(series, axis=1)
+        else:
+            output = pd.DataFrame(index=range(len(index)))
+        output.columns = names[positions]
+        output.index = index
+        return output
+
+    @classmethod
+    def decode(cls, stored):
+        stored = memoryview(stored)
+        return cls.decodeColumns(lambda offset, length: stored[offset:offset + length])
+
+
+registerValueDecoder(PICKLE_HEADER, PickleCodec.decode)
+registerValueDecoder(OUT_OF_BAND_HEADER, PickleCodec.decodeOutOfBand)
+registerValueDecoder(ZLIB_HEADER, ZlibCodec.decode)
+registerValueDecoder(LZMA_HEADER, LzmaCodec.decode)
+registerValueDecoder(JSON_HEADER, JsonCodec.decode)
+registerValueDecoder(BYTES_HEADER, BytesCodec.decode)
+registerValueDecoder(COLUMNS_HEADER, ColumnarCodec.decode)
+
+
+class ReadCache:
+    """LRU cache of decoded values for Resource.get, set as the cache of a Resource subclass
+
+    Only reads made outside of a txn use the cache, so a txn always sees its own writes.
+    Writes through the Resource invalidate their key once the write lock is held, and any
+    read which started before an invalidation is not stored, so uncommitted or replaced
+    values are never served. Writes made by other processes are not seen, and cached values
+    are shared between callers so they shouldn't be modified."""
+
+    def __init__(self, maxEntries=1000, maxBytes=None):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def read(self, resource):
+        key = (resource.filename, resource.db_key)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            generation = self.generation
+
+        out = resource.db.get(resource.db_key)
+
+        if out is None:
+            return resource.make()
+
+        value = resource.fromStorable(out)
+        self.store(key, value, len(out), generation)
+        return value
+
+    def store(self, key, value, size, generation):
+        with self.lock:
+            # Something was written since the read began, so the value could be stale
+            if generation != self.generation:
+                return
+            if self.maxBytes is not None and size > self.maxBytes:
+                return
+            self.entries[key] = (value, size)
+            self.bytes += size
+            while len(self.entries) > self.maxEntries or \
+                    (self.maxBytes is not None and self.bytes > self.maxBytes):
+                evictedKey, (evicted, evictedSize) = self.entries.popitem(last=False)
+                self.bytes -= evictedSize
+
+    def invalidate(self, filename, dbKey):
+        with self.lock:
+            self.generation += 1
+            self.invalidations += 1
+            entry = self.entries.pop((filename, dbKey), None)
+            if entry is not None:
+                self.bytes -= entry[1]
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'invalidations': self.invalidations,
+                    'entries': len(self.entries),
+                    'bytes': self.bytes,
+                    'hitRatio': self.hits / lookups if lookups else 0.0}
+
+
+class AsyncWorker:
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='simpleBDB')
+        self.pending = 0
+
+
+class AsyncExecutor:
+    """Runs BerkeleyDB calls for asyncio code on a bounded number of worker threads
+
+    Each worker is a single thread, so a txn and its cursors can stay on the worker which
+    began them while other calls go to whichever worker has the least queued"""
+
+    def __init__(self, workers=4):
+        self.workers = [AsyncWorker() for i in range(workers)]
+
+    def pick(self):
+        return min(self.workers, key=lambda worker: worker.pending)
+
+    async def run(self, func, *args, worker=None, **kwargs):
+        if worker is None:
+            worker = self.pick()
+        worker.pending += 1
+        try:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(worker.executor, functools.partial(func, *args, **kwargs))
+        finally:
+            worker.pending -= 1
+
+    def shutdown(self, wait=True):
+        for worker in self.workers:
+            worker.executor.shutdown(wait=wait)
+
+
+asyncExecutor = None
+asyncExecutorLock = threading.Lock()
+
+
+def getAsyncExecutor():
+    global asyncExecutor
+    with asyncExecutorLock:
+        if asyncExecutor is None:
+            asyncExecutor = AsyncExecutor()
+        return asyncExecutor
+
+
+def setAsyncWorkers(workers):
+    """Replaces the async executor with one using this many worker threads"""
+    global asyncExecutor
+    with asyncExecutorLock:
+        old = asyncExecutor
+        asyncExecutor = AsyncExecutor(workers)
+    if old is not None:
+        old.shutdown(wait=False)
+
+
+class AsyncTxn:
+    """A txn for asyncio code, pinned to the worker thread which began it
+
+    Use with async with, the txn commits when the block exits and aborts if it raises.
+    Pass it as the txn of the async Resource and Cursor methods."""
+
+    def __init__(self, parent=None, flags=0):
+        self.parent = parent
+        self.flags = flags
+        self.txn = None
+        self.worker = None
+
+    async def begin(self):
+        executor = getAsyncExecutor()
+        parent = self.parent
+        if isinstance(parent, AsyncTxn):
+            self.worker = parent.worker
+            parent = parent.txn
+        else:
+            self.worker = executor.pick()
+        self.txn = await executor.run(getEnvTxn, parent=parent, flags=self.flags, worker=self.worker)
+        return self
+
+    async def commit(self, flags=0):
+        await getAsyncExecutor().run(self.txn.commit, flags, worker=self.worker)
+        if metrics.enabled:
+            metrics.count('txn.commit')
+
+    async def abort(self):
+        await getAsyncExecutor().run(self.txn.abort, worker=self.worker)
+        if metrics.enabled:
+            metrics.count('txn.abort')
+
+    async def __aenter__(self):
+        return await self.begin()
+
+    async def __aexit__(self, excType, exc, traceback):
+        if excType is None:
+            await self.commit()
+            return False
+        await self.abort()
+        # Same as txnAbortOnError, AbortTXNException only aborts
+        return issubclass(excType, AbortTXNException)
+
+
+def atxn(parent=None, flags=0):
+    return AsyncTxn(parent=parent, flags=flags)
+
+
+async def runAsync(func, *args, txn=None, **kwargs):
+    """Runs func on an async worker, on the worker of txn when it is an AsyncTxn"""
+    if isinstance(txn, AsyncTxn):
+        return await getAsyncExecutor().run(func, *args, txn=txn.txn, worker=txn.worker, **kwargs)
+    return await getAsyncExecutor().run(func, *args, txn=txn, **kwargs)
+
+
+def takeItems(items, count):
+    return list(itertools.islice(items, count))
+
+
 class DB(type):
     """Metaclass for Resource objects"""
 
@@ -112,21 +955,67 @@ class DB(type):
         if "keys" in dir(cls):
             cls.filename = name
             DBS.append(cls)
+            # Its own, so lookups don't find the db of an open parent class first
+            cls.db = LazyHandle()
 
     def setDB(cls):
         if env is None:
             raise EnvNotCreatedException
-        cls.db = db.DB(env)
-        cls.db.open(cls.filename, None, cls.DBTYPE,
-                    db.DB_AUTO_COMMIT |
-                    db.DB_CREATE)
+        handle = db.DB(env)
+        if cls.pageSize is not None:
+            handle.set_pagesize(cls.pageSize)
+        cls.configureDb(handle)
+        handle.open(cls.filename, None, cls.DBTYPE, cls.openFlags())
+
+        # Other threads only see the handle once the extra files are open too
+        if not hasattr(opening, 'handles'):
+            opening.handles = {}
+        opening.handles[cls] = handle
+        try:
+            cls.openExtraDbs()
+        finally:
+            del opening.handles[cls]
+        cls.db = handle
+
+    def openOnce(cls):
+        """Opens cls unless it already is, safe to call from many threads"""
+        with openLock:
+            if not cls.isOpen():
+                cls.setDB()
+        return cls.ownHandle()
+
+    def ownHandle(cls):
+        """The handle cls opened, None when it isn't open"""
+        handle = cls.__dict__.get('db')
+        if isinstance(handle, LazyHandle):
+            return None
+        return handle
+
+    def isOpen(cls):
+        return cls.ownHandle() is not None
+
+    def forgetDB(cls):
+        """Drops the handle, so db is None, or opens again on use when lazy"""
+        if cls.ownHandle() is not None:
+            cls.db = LazyHandle()
+
+    def openFlags(cls):
+        flags = db.DB_AUTO_COMMIT | db.DB_THREAD | db.DB_CREATE
+        if cls.multiversion:
+            flags = flags | db.DB_MULTIVERSION
+        return flags
 
     def close(cls):
-        if cls.db is None:
+        if not cls.isOpen():
             raise DBNeverOpenedException
+        cls.closeExtraDbs()
         cls.db.close()
+        cls.forgetDB()
 
-    def getCursor(cls, txn=None, readCommited=False, bulk=False):
+    def getCursor(cls, txn=None, readCommited=False, bulk=False, snapshot=False, keysOnly=False):
+        """snapshot reads multiversion files as of when the cursor is opened, without read locks
+
+        keysOnly skips reading the values, which the cursor returns as None"""
 
         if cls.db is None:
             raise DBNeverOpenedException
@@ -145,7 +1034,26 @@ class DB(type):
             else:
                 flags = db.DB_CURSOR_BULK
 
-        return Cursor(cls.db.cursor(txn=txn, flags=flags), cls)
+        if snapshot:
+            if flags != 0:
+                flags = flags | db.DB_TXN_SNAPSHOT
+            else:
+                flags = db.DB_TXN_SNAPSHOT
+
+        return Cursor(cls.db.cursor(txn=txn, flags=flags), cls, keysOnly=keysOnly, txn=txn)
+
+    async def agetCursor(cls, txn=None, readCommited=False, bulk=False, snapshot=False, keysOnly=False):
+        """getCursor for asyncio code, the cursor's async methods run on the worker it was made on"""
+        if isinstance(txn, AsyncTxn):
+            worker = txn.worker
+            txn = txn.txn
+        else:
+            worker = getAsyncExecutor().pick()
+        cursor = await getAsyncExecutor().run(cls.getCursor, txn=txn, readCommited=readCommited,
+                                              bulk=bulk, snapshot=snapshot, keysOnly=keysOnly,
+                                              worker=worker)
+        cursor.worker = worker
+        return cursor
 
     def syncDb(cls):
         if cls.db is None:
@@ -154,72 +1062,145 @@ class DB(type):
 
 
 class Cursor:
-    def __init__(self, cursor, parent):
+    def __init__(self, cursor, parent, keysOnly=False, txn=None):
         self.cursor = cursor
         self.parent = parent
+        # The txn the cursor was opened in, which writes through it also touch other files in
+        self.txn = txn
+        # Set for cursors made by agetCursor
+        self.worker = None
+        # Reads ask for 0 bytes of each value, so only the keys are copied out, values are None
+        self.keysOnly = keysOnly
+        self.partial = {'dlen': 0, 'doff': 0} if keysOnly else {}
+
+    def decode(self, key, value):
+        if self.keysOnly:
+            return self.parent.fromKeyStore(key), None
+        return self.parent.fromKeyStore(key), self.parent.fromStorable(value)
 
+    async def runAsync(self, func, *args, **kwargs):
+        return await getAsyncExecutor().run(func, *args, worker=self.worker, **kwargs)
+
+    async def aget(self, flags=0):
+        return await self.runAsync(self.get, flags=flags)
+
+    async def anext(self, flags=0):
+        return await self.runAsync(self.next, flags=flags)
+
+    async def anext_batch(self, n, flags=0):
+        return await self.runAsync(self.next_batch, n, flags=flags)
+
+    async def aclose(self):
+        return await self.runAsync(self.close)
+
+    @instrumented('cursor.get')
     def get(self, flags=0):
         try:
-            returnVal = self.cursor.get(flags=flags)
+            returnVal = self.cursor.get(flags=flags, **self.partial)
         except db.DBLockDeadlockError:
             self.cursor.close()
             raise
         if returnVal is None:
             return None
         else:
-            key, value = returnVal
-            return self.parent.fromKeyStore(key), self.parent.fromStorable(value)
+            return self.decode(*returnVal)
 
+    @instrumented('cursor.get')
     def getWithKey(self, key, flags=db.DB_SET):
         key = self.parent.toKeyStore(key)
         try:
-            out = self.cursor.get(key, flags=flags)
+            out = self.cursor.get(key, flags=flags, **self.partial)
         except db.DBLockDeadlockError:
             self.cursor.close()
             raise
         if out is None:
             return None
         else:
-            key, value = out
-            return self.parent.fromKeyStore(key), self.parent.fromStorable(value)
+            return self.decode(*out)
 
+    @instrumented('cursor.put')
     def put(self, key, value, flags=db.DB_CURRENT):
         # Set DB
         key = self.parent.toKeyStore(key)
         try:
             self.cursor.set(key)
             self.cursor.put(key, self.parent.toStorable(value), flags=flags)
+            self.parent.valueReplaced(key, txn=self.txn)
         except db.DBLockDeadlockError:
             self.cursor.close()
             raise
+        self.parent.invalidateCached(key)
 
+    @instrumented('cursor.next')
     def next(self, flags=0):
         try:
-            output = self.cursor.next(flags=flags)
+            output = self.cursor.next(flags=flags, **self.partial)
         except db.DBLockDeadlockError:
             self.cursor.close()
             raise
         if output is None:
             return None
-        key, value = output
 
-        return self.parent.fromKeyStore(key), self.parent.fromStorable(value)
+        return self.decode(*output)
 
     def first(self, flags=0):
         try:
-            output = self.cursor.first(flags=flags)
+            output = self.cursor.first(flags=flags, **self.partial)
         except db.DBLockDeadlockError:
             self.cursor.close()
             raise
         if output is None:
             return None
-        key, value = output
 
-        return self.parent.fromKeyStore(key), self.parent.fromStorable(value)
+        return self.decode(*output)
+
+    @instrumented('cursor.batch')
+    def nextRecords(self, count=None, bufferBytes=None, flags=0):
+        """Reads undecoded records after the current position
+
+        Stops once count records are held, or once the keys and values read add up to
+        bufferBytes. Returns an empty list when there is nothing left."""
+        nextRecord = self.cursor.next
+        partial = self.partial
+        records = []
+        size = 0
+        try:
+            while count is None or len(records) < count:
+                record = nextRecord(flags=flags, **partial)
+                if record is None:
+                    break
+                records.append(record)
+                if bufferBytes is not None:
+                    size += len(record[0]) + len(record[1])
+                    if size >= bufferBytes:
+                        break
+        except db.DBLockDeadlockError:
+            self.cursor.close()
+            raise
+        return records
+
+    def decodeRecords(self, records):
+        fromKeyStore = self.parent.fromKeyStore
+        if self.keysOnly:
+            return [(fromKeyStore(key), None) for key, value in records]
+        fromStorable = self.parent.fromStorable
+        return [(fromKeyStore(key), fromStorable(value)) for key, value in records]
+
+    def next_batch(self, n, flags=0):
+        """Returns up to n decoded records after the current position"""
+        return self.decodeRecords(self.nextRecords(count=n, flags=flags))
+
+    def iter_batches(self, buffer_bytes=1048576, flags=0):
+        """Yields lists of decoded records, each list holding roughly buffer_bytes of data"""
+        while True:
+            records = self.nextRecords(bufferBytes=buffer_bytes, flags=flags)
+            if not records:
+                return
+            yield self.decodeRecords(records)
 
     def dup(self, flags=db.DB_POSITION):
         try:
-            return Cursor(self.cursor.dup(flags), self.parent)
+            return Cursor(self.cursor.dup(flags), self.parent, keysOnly=self.keysOnly, txn=self.txn)
         except db.DBLockDeadlockError:
             self.cursor.close()
             raise
@@ -228,11 +1209,14 @@ class Cursor:
         return self.cursor.close()
 
     def delete(self):
+        key = self.cursor.current(dlen=0, doff=0)[0]
         self.cursor.delete()
+        self.parent.valueReplaced(key, txn=self.txn)
+        self.parent.invalidateCached(key)
 
     def current(self, flags=0):
         try:
-            output = self.cursor.current(flags=flags)
+            output = self.cursor.current(flags=flags, **self.partial)
         except db.DBLockDeadlockError:
             self.cursor.close()
             raise
@@ -241,24 +1225,172 @@ class Cursor:
         key, value = output
 
         try:
-            return self.parent.fromKeyStore(key), self.parent.fromStorable(value)
+            return self.decode(key, value)
         except TypeError:
             return key, value
 
 
+class LazyHandle:
+    """The db of a Resource subclass until setDB sets the subclass's own
+
+    It is None, unless open_dbs(lazy=True) was called, in which case the subclass is
+    opened by the first lookup. Each registered class has its own, which setDB replaces
+    with the handle and forgetDB puts back."""
+
+    def __get__(self, instance, owner):
+        handles = getattr(opening, 'handles', None)
+        if handles and owner in handles:
+            return handles[owner]
+        if not lazyOpen or owner not in DBS:
+            return None
+        return owner.openOnce()
+
+
 class Resource(metaclass=DB):
     """Base class for berkeleydb files"""
     DBTYPE = db.DB_BTREE
+    # Set to TupleKeyCodec for ordered keys, existing files need migrateKeyCodec
+    keyCodec = PickleKeyCodec
+    # Only used for writing, values are decoded based on their header byte
+    valueCodec = PickleCodec()
+    # Set to a ReadCache to cache values read outside of a txn
+    cache = None
+    # Page size in bytes for new files, None lets BerkeleyDB pick one
+    pageSize = None
+    # Open with DB_MULTIVERSION, so snapshot reads don't lock out writers
+    multiversion = False
+    # DB_HASH tuning, the number of keys to fill each bucket page with, and the number of
+    # keys expected, which sizes the table up front. None lets BerkeleyDB pick
+    hashFillFactor = None
+    hashSize = None
+    # DB_BTREE tuning, the fewest keys a page holds before bigger values go to overflow pages
+    btreeMinKey = None
+    # Index name to a function which takes a value and returns what to index it by, or None
+    indexes = {}
+    indexDbs = None
+
+    @classmethod
+    def invalidateCached(cls, dbKey):
+        if cls.cache is not None:
+            cls.cache.invalidate(cls.filename, dbKey)
+
+    @classmethod
+    def valueReplaced(cls, dbKey, txn=None):
+        """Called within the txn of every write which replaces or deletes the whole value of dbKey"""
+        pass
+
+    @classmethod
+    def scannedValue(cls, key, value, txn):
+        """Called by iter_items on each decoded value, within the txn of the scan"""
+        return value
+
+    @classmethod
+    def configureDb(cls, handle):
+        """Called by setDB before the file is opened, override to set access method options"""
+        if cls.DBTYPE == db.DB_HASH:
+            if cls.hashFillFactor is not None:
+                handle.set_h_ffactor(cls.hashFillFactor)
+            if cls.hashSize is not None:
+                handle.set_h_nelem(cls.hashSize)
+        elif cls.DBTYPE == db.DB_BTREE:
+            if cls.btreeMinKey is not None:
+                handle.set_bt_minkey(cls.btreeMinKey)
+
+    @classmethod
+    def orderedScans(cls):
+        """Whether the keys are stored in key order, so a prefix of them is a range of records
+
+        DB_HASH files are never in key order, so they always scan every record"""
+        return cls.keyCodec.ordered and cls.DBTYPE == db.DB_BTREE
+
+    @classmethod
+    def openExtraDbs(cls):
+        """Called by setDB, override to open any other files the subclass stores data in
+
+        Opens a secondary DB for each index, which BerkeleyDB keeps up to date within the
+        txn of every write to the main DB"""
+        cls.indexDbs = {}
+        for name, extract in cls.indexes.items():
+            secondary = db.DB(env)
+            secondary.set_flags(db.DB_DUPSORT)
+            secondary.open(cls.indexFilename(name), None, db.DB_BTREE, cls.openFlags())
+
+            # DB_CREATE indexes the existing records when the index is new
+            txn = getEnvTxn()
+            try:
+                cls.db.associate(secondary, cls.indexCallback(extract), db.DB_CREATE, txn=txn)
+                txn.commit()
+            except:
+                txn.abort()
+                raise
+            cls.indexDbs[name] = secondary
+
+    @classmethod
+    def closeExtraDbs(cls):
+        """Called by close, before the main DB is closed"""
+        if cls.indexDbs is not None:
+            for secondary in cls.indexDbs.values():
+                secondary.close()
+            cls.indexDbs = None
+
+    @classmethod
+    def indexFilename(cls, name):
+        return '%s.index.%s' % (cls.filename, name)
+
+    @classmethod
+    def indexKey(cls, value):
+        # Tagged with the type, so 1 and '1' are different index keys
+        return TupleKeyCodec.encode((type(value).__name__, value))
+
+    @classmethod
+    def indexCallback(cls, extract):
+        def callback(key, data):
+            indexed = extract(cls.fromStorable(data))
+            # None tells BerkeleyDB not to index this record
+            if indexed is None:
+                return None
+            return cls.indexKey(indexed)
+
+        return callback
+
+    @classmethod
+    def find_by(cls, name, value, txn=None):
+        """Get a list of (key, value) for each entry which the index name maps to value
+
+        value has to be of the same type as what the index function returned. The index is
+        of the stored values, so for a Container with deltaLog it is of the value before
+        its deltas, which are applied to the values returned."""
+        # Looking up db opens the index files too when opening lazily
+        if cls.db is None or cls.indexDbs is None or name not in cls.indexDbs:
+            raise ValueError('%s has no index named %s' % (cls.__name__, name))
+        if txn is None:
+            # The values and any deltas applied to them are read in one txn
+            return retry(txnAbortOnError(cls.find_by))(name, value)
+
+        output = []
+        cursor = cls.indexDbs[name].cursor(txn=txn)
+        try:
+            record = cursor.pget(cls.indexKey(value), db.DB_SET)
+            while record is not None:
+                # The index key is only included in some versions of the output
+                primaryKey, data = record[-2:]
+                key = cls.fromKeyStore(primaryKey)
+                output.append((key, cls.scannedValue(key, cls.fromStorable(data), txn)))
+                record = cursor.pget(db.DB_NEXT_DUP)
+        finally:
+            cursor.close()
+
+        return output
 
     @classmethod
     def fromKeyStore(cls, key):
         """Converts a key from the DB into a list of str key entries"""
-        return pickle.loads(key)
+        return cls.keyCodec.decode(key)
 
     @classmethod
     def toKeyStore(cls, key):
         """Converts a list of str key entries into a key which can be used by the DB"""
-        return pickle.dumps(key, 1)
+        return cls.keyCodec.encode(key)
 
     @classmethod
     def keyToEntryTuple(cls, key):
@@ -273,40 +1405,181 @@ class Resource(metaclass=DB):
         return tuple(output)
 
     @classmethod
+    @instrumented('decode')
     def fromStorable(cls, storable):
         """Takes the output from the DB and converts it to the way it should be"""
-        return pickle.loads(storable)
+        return decodeValue(storable)
 
     @classmethod
+    @instrumented('encode')
     def toStorable(cls, data):
-        return pickle.dumps(data, 1)
+        return cls.valueCodec.encode(data)
 
     @classmethod
-    def length(cls):
+    def length(cls, fast=False, txn=None):
+        """Number of keys in the DB, counted by BerkeleyDB without loading the keys
+
+        fast returns the count saved by the last full count instead of walking the DB.
+        That count is 0 until a full count has been done, so a 0 is counted in full."""
+        flags = 0
+        if fast:
+            flags = db.DB_FAST_STAT
+
         try:
-            keys = cls.db.keys()
-            return len(keys)
+            stats = cls.db.stat(flags=flags, txn=txn)
+            if fast and stats['nkeys'] == 0:
+                stats = cls.db.stat(txn=txn)
         except AttributeError:
             return 0
 
+        return stats['nkeys']
+
+    @classmethod
+    def count_prefix(cls, *args, fast=False, txn=None):
+        """Count the keys starting with the passed values without decoding any values
+
+        fast estimates the count with key_range when keyCodec is ordered"""
+        if not args:
+            return cls.length(fast=fast, txn=txn)
+
+        if cls.db is None:
+            return 0
+
+        prefix = tuple(str(arg) for arg in args)
+
+        if not cls.orderedScans():
+            lenPrefix = len(prefix)
+            count = 0
+            cursor = cls.db.cursor(txn=txn)
+            try:
+                record = cursor.first(dlen=0, doff=0)
+                while record is not None:
+                    if cls.fromKeyStore(record[0])[:lenPrefix] == prefix:
+                        count += 1
+                    record = cursor.next(dlen=0, doff=0)
+            finally:
+                cursor.close()
+            return count
+
+        start, end = cls.keyCodec.prefixRange(prefix)
+
+        if fast:
+            total = cls.length(fast=True, txn=txn)
+            before = cls.db.key_range(start, txn=txn)[0]
+            after = cls.db.key_range(end, txn=txn)[0]
+            return int(round((after - before) * total))
+
+        count = 0
+        cursor = cls.db.cursor(txn=txn)
+        try:
+            record = cursor.set_range(start, dlen=0, doff=0)
+            # Ordered keys can be compared as bytes, so nothing gets decoded
+            while record is not None and record[0] < end:
+                count += 1
+                record = cursor.next(dlen=0, doff=0)
+        finally:
+            cursor.close()
+        return count
+
     @classmethod
-    def all(cls, txn=None):
-        tuples = cls.db_key_tuples()
-        return [cls(*tup).get(txn=txn) for tup in tuples]
+    def all(cls, txn=None, snapshot=False):
+        return [value for key, value in cls.iter_items(txn=txn, snapshot=snapshot)]
 
     @classmethod
-    def all_dict(cls, txn=None):
-        tuples = cls.db_key_tuples()
-        return {tup: cls(*tup).get(txn=txn) for tup in tuples}
+    def all_dict(cls, txn=None, snapshot=False):
+        return dict(cls.iter_items(txn=txn, snapshot=snapshot))
 
     @classmethod
-    def db_keys(cls):
+    def iter_items(cls, txn=None, prefix=(), batch=1000, snapshot=False):
+        """Lazily yields each (key, value) pair using a single pass of one cursor
+
+        prefix limits the output to keys starting with those values, which becomes a range
+        scan when keyCodec is ordered. batch is the number of records read before they get
+        decoded. A passed txn reads every record under its locks, so the scan is serializable.
+        Otherwise the scan runs in its own txn, which is a snapshot_txn when snapshot is set
+        or the class is multiversion, and else reads committed so the read locks of the pages
+        it has passed are released, rather than blocking writers and filling the lock table."""
+        if cls.db is None:
+            return
+
+        prefix = tuple(str(entry) for entry in prefix)
+        lenPrefix = len(prefix)
+        rangeScan = lenPrefix > 0 and cls.orderedScans()
+
+        ownTxn = txn is None
+        if ownTxn:
+            snapshot = snapshot or cls.multiversion
+            txn = snapshot_txn() if snapshot else getEnvTxn()
+
+        cursor = cls.getCursor(txn=txn, bulk=True, readCommited=ownTxn and not snapshot)
         try:
-            dbKeys = cls.db.keys()
-        except AttributeError:
-            return []
+            if rangeScan:
+                records = []
+                record = cursor.cursor.set_range(cls.toKeyStore(prefix))
+                if record is not None:
+                    records.append(record)
+                    records.extend(cursor.nextRecords(count=batch - 1))
+            else:
+                records = cursor.nextRecords(count=batch)
+
+            while records:
+                for key, value in records:
+                    key = cls.fromKeyStore(key)
+                    if key[:lenPrefix] != prefix:
+                        if rangeScan:
+                            records = []
+                            break
+                        continue
+                    yield key, cls.scannedValue(key, cls.fromStorable(value), txn)
+                else:
+                    records = cursor.nextRecords(count=batch)
+        except:
+            cursor.close()
+            if ownTxn:
+                txn.abort()
+                if metrics.enabled:
+                    metrics.count('txn.abort')
+            raise
 
-        return [cls.fromKeyStore(k) for k in dbKeys]
+        cursor.close()
+        if ownTxn:
+            txn.commit()
+            if metrics.enabled:
+                metrics.count('txn.commit')
+
+    @classmethod
+    def db_keys(cls):
+        return list(cls.iter_keys())
+
+    @classmethod
+    def iter_keys(cls, txn=None, prefix=()):
+        """Lazily yields each key tuple without reading any values
+
+        prefix limits the output to keys starting with those values, which becomes a range
+        scan when keyCodec is ordered"""
+        if cls.db is None:
+            return
+
+        prefix = tuple(str(entry) for entry in prefix)
+        lenPrefix = len(prefix)
+        rangeScan = lenPrefix > 0 and cls.orderedScans()
+
+        cursor = cls.getCursor(txn=txn, keysOnly=True)
+        try:
+            if rangeScan:
+                current = cursor.getWithKey(prefix, flags=db.DB_SET_RANGE)
+            else:
+                current = cursor.first()
+
+            while current is not None:
+                key = current[0]
+                if key[:lenPrefix] == prefix:
+                    yield key
+                elif rangeScan:
+                    break
+                current = cursor.next()
+        finally:
+            cursor.close()
 
     @classmethod
     def db_key_tuples(cls):
@@ -326,6 +1599,9 @@ class Resource(metaclass=DB):
                              'Len Class Keys: %s\n'
                              'Len Provided Keys: %s\n' % (len(cls.keys), len(args)))
 
+        if cls.orderedScans():
+            return cls.keysWithPrefix(*args)
+
         index = 0
         output = cls.db_key_tuples()
 
@@ -340,6 +1616,13 @@ class Resource(metaclass=DB):
 
         return output
 
+    @classmethod
+    def keysWithPrefix(cls, *args, txn=None):
+        """Get all keys starting with the passed values, without reading any values
+
+        This is a range scan when keyCodec is ordered, otherwise every key is checked"""
+        return list(cls.iter_keys(txn=txn, prefix=args))
+
     def rename(self, **kwargs):
         """Read data for this key, delete that db entry, and save it under another key"""
         for k in kwargs:
@@ -393,6 +1676,82 @@ class Resource(metaclass=DB):
 
         return cls.db.exists(cls.toKeyStore(k), txn=txn, flags=flags)
 
+    @classmethod
+    def put_many(cls, items, txn=None, chunk=10000, durability=None):
+        """Put each (key tuple, value) pair, writing them in key order
+
+        A value of None deletes that key, missing keys are skipped.
+        durability applies to the txns made for each chunk when no txn is passed"""
+        records = [(cls.toKeyStore(cls.keyToEntryTuple(key)),
+                    None if value is None else cls.toStorable(value))
+                   for key, value in items]
+        # Stable, so a repeated key still ends up with its last value
+        records.sort(key=lambda record: record[0])
+
+        def putChunk(chunkRecords, txn=None):
+            for key, value in chunkRecords:
+                if value is None:
+                    try:
+                        cls.db.delete(key, txn=txn)
+                    except db.DBNotFoundError:
+                        pass
+                else:
+                    cls.db.put(key, value, txn=txn)
+                cls.valueReplaced(key, txn=txn)
+                cls.invalidateCached(key)
+            return []
+
+        runChunked(putChunk, records, txn=txn, chunk=chunk, durability=durability)
+
+    @classmethod
+    def get_many(cls, keys, txn=None, write=False, chunk=10000):
+        """Get the value of each key tuple, returned in the same order as keys"""
+        flags = 0
+        if write:
+            flags = db.DB_RMW
+
+        keys = [cls.keyToEntryTuple(key) for key in keys]
+        storeKeys = [cls.toKeyStore(key) for key in keys]
+        order = sorted(range(len(keys)), key=lambda index: storeKeys[index])
+
+        def getChunk(indexes, txn=None):
+            return [cls.db.get(storeKeys[index], txn=txn, flags=flags) for index in indexes]
+
+        stored = runChunked(getChunk, order, txn=txn, chunk=chunk)
+
+        output = [None] * len(keys)
+        for index, value in zip(order, stored):
+            if value is None:
+                output[index] = cls(*keys[index]).make()
+            else:
+                output[index] = cls.fromStorable(value)
+        return output
+
+    @classmethod
+    def delete_many(cls, keys, txn=None, chunk=10000):
+        """Delete each key tuple, returns whether each key existed in the same order as keys"""
+        storeKeys = [cls.toKeyStore(cls.keyToEntryTuple(key)) for key in keys]
+        order = sorted(range(len(storeKeys)), key=lambda index: storeKeys[index])
+
+        def deleteChunk(indexes, txn=None):
+            deleted = []
+            for index in indexes:
+                try:
+                    cls.db.delete(storeKeys[index], txn=txn)
+                    deleted.append(True)
+                except db.DBNotFoundError:
+                    deleted.append(False)
+                cls.valueReplaced(storeKeys[index], txn=txn)
+                cls.invalidateCached(storeKeys[index])
+            return deleted
+
+        removed = runChunked(deleteChunk, order, txn=txn, chunk=chunk)
+
+        output = [False] * len(storeKeys)
+        for index, wasDeleted in zip(order, removed):
+            output[index] = wasDeleted
+        return output
+
     def __init__(self, *args):
         if len(args) != len(self.keys):
             raise ValueError(
@@ -414,8 +1773,18 @@ class Resource(metaclass=DB):
         self.put(after, txn=txn)
         return after
 
+    @instrumented('get')
+    @snapshotRead
     def get(self, txn=None, write=False):
-        """Get method for resource, and its subclasses"""
+        """Get method for resource, and its subclasses
+
+        Reads outside of a txn go through the cache when the class has one.
+        snapshot=True reads in a snapshot_txn instead, which skips the cache."""
+        if self.cache is None or txn is not None or write:
+            return self.getUncached(txn=txn, write=write)
+        return self.cache.read(self)
+
+    def getUncached(self, txn=None, write=False):
         flags = 0
         if write:
             flags = db.DB_RMW
@@ -427,6 +1796,92 @@ class Resource(metaclass=DB):
 
         return self.fromStorable(out)
 
+    def readStored(self, offset, length, txn=None, dbKey=None):
+        """Reads length bytes from offset of the stored value, without reading the rest of it
+
+        Returns None when nothing is stored, and less than length bytes past the end"""
+        if dbKey is None:
+            dbKey = self.db_key
+        return self.db.get(dbKey, txn=txn, dlen=length, doff=offset)
+
+    def checkBytesStored(self, txn=None):
+        header = self.readStored(0, 1, txn=txn)
+        if header is None:
+            return False
+        if header != BYTES_HEADER:
+            raise ValueError('%s is not stored with BytesCodec' % repr(self))
+        return True
+
+    def get_range(self, start, length, txn=None):
+        """Reads length bytes from start of a value stored with BytesCodec, None if there isn't one"""
+        if not self.checkBytesStored(txn=txn):
+            return None
+        return self.readStored(start + 1, length, txn=txn)
+
+    def put_range(self, start, data, txn=None):
+        """Overwrites the bytes from start of a value stored with BytesCodec, extending it if needed"""
+        if not self.checkBytesStored(txn=txn):
+            raise KeyError(repr(self))
+        self.db.put(self.db_key, data, txn=txn, dlen=len(data), doff=start + 1)
+        self.invalidateCached(self.db_key)
+
+    def iter_bytes(self, chunk=1048576, txn=None):
+        """Streams a value stored with BytesCodec chunk bytes at a time
+
+        Without a txn the reads run in their own txn so they see one version of the value"""
+        ownTxn = txn is None
+        if ownTxn:
+            txn = getEnvTxn()
+
+        try:
+            if self.checkBytesStored(txn=txn):
+                offset = 1
+                while True:
+                    data = self.readStored(offset, chunk, txn=txn)
+                    if data:
+                        yield data
+                    if data is None or len(data) < chunk:
+                        break
+                    offset += chunk
+        except:
+            if ownTxn:
+                txn.abort()
+            raise
+
+        if ownTxn:
+            txn.commit()
+
+    async def aget(self, txn=None, write=False, snapshot=False):
+        return await runAsync(self.get, txn=txn, write=write, snapshot=snapshot)
+
+    async def aput(self, value, txn=None):
+        return await runAsync(self.put, value, txn=txn)
+
+    async def aalter(self, fun, txn=None):
+        return await runAsync(self.alter, fun, txn=txn)
+
+    @classmethod
+    async def aiter(cls, txn=None, prefix=(), batch=1000):
+        """Async iter_items, each batch of items is read on the worker thread"""
+        executor = getAsyncExecutor()
+        if isinstance(txn, AsyncTxn):
+            worker = txn.worker
+            txn = txn.txn
+        else:
+            worker = executor.pick()
+
+        items = cls.iter_items(txn=txn, prefix=prefix, batch=batch)
+        try:
+            while True:
+                chunk = await executor.run(takeItems, items, batch, worker=worker)
+                for item in chunk:
+                    yield item
+                if len(chunk) < batch:
+                    return
+        finally:
+            # Closes the cursor and any txn of the scan on the thread which made them
+            await executor.run(items.close, worker=worker)
+
     def make(self):
         """Make function for when object doesn't exist
 
@@ -437,32 +1892,180 @@ class Resource(metaclass=DB):
             return None
         return made
 
+    @instrumented('put')
     def put(self, value, txn=None):
         """Put method for resource, and its subclasses"""
         if value is None:
             self.db.delete(self.db_key, txn=txn)
         else:
             self.db.put(self.db_key, self.toStorable(value), txn=txn)
+        self.valueReplaced(self.db_key, txn=txn)
+        # Only after the write, once readers of this key are blocked on its lock
+        self.invalidateCached(self.db_key)
 
     def __repr__(self):
-        return '%s("%s")' % (self.__class__.__name__, self.fromStorable(self.db_key))
+        # From the key entries, as the stored key isn't a pickle for every keyCodec
+        return '%s("%s")' % (self.__class__.__name__, self.values)
+
+
+# Set after the class body, where db is still the berkeleydb module
+Resource.db = LazyHandle()
 
 
 class Container(Resource):
     """Methods to support updating lists or dicts.
 
-    Subclasses will require an add_item and remove_item function"""
+    Subclasses will require an add_item and remove_item function
+
+    Set deltaLog to store each add and remove as a small record in a second file instead of
+    rewriting the whole value, get then applies them to the stored value. Once a key has
+    deltaThreshold of these records they are compacted back into the value. As the value
+    isn't read when a delta is stored, an add_item or remove_item which raises, such as
+    removing a missing item, can't fail that add or remove. The delta is skipped and logged
+    each time it is applied instead, until compaction drops it."""
+    deltaLog = False
+    deltaThreshold = 100
+    deltaDb = None
+
+    @classmethod
+    def openExtraDbs(cls):
+        super().openExtraDbs()
+        if cls.deltaLog:
+            cls.deltaDb = db.DB(env)
+            # Unsorted duplicates keep the records of a key in the order they were added
+            cls.deltaDb.set_flags(db.DB_DUP)
+            cls.deltaDb.open(cls.filename + '.deltas', None, db.DB_BTREE, cls.openFlags())
+
+    @classmethod
+    def closeExtraDbs(cls):
+        if cls.deltaDb is not None:
+            cls.deltaDb.close()
+            cls.deltaDb = None
+        super().closeExtraDbs()
 
     def add(self, item, txn=None):
+        """Add item to the container
+
+        When the item is stored as a delta record the value isn't read, so None is returned
+        in place of the value after the add"""
         self.item = item
+        if self.deltaLog and self.appendDelta('add', item, txn=txn):
+            return self.item, None
         after = self.alter(self.add_item, txn=txn)
         return self.item, after
 
     def remove(self, item, txn=None):
+        """Remove item from the container
+
+        When the removal is stored as a delta record nothing is read, so None is returned
+        in place of both the removed item and the value after the removal"""
         self.item = item
+        if self.deltaLog and self.appendDelta('remove', item, txn=txn):
+            return None, None
         after = self.alter(self.remove_item, txn=txn)
         return self.removed, after
 
+    def appendDelta(self, operation, item, txn=None):
+        """Stores the operation as a delta record, returns False when there is no value to apply it to
+
+        Without a txn this runs in its own, so a compaction can't drop a delta another
+        thread appends between its read and its write."""
+        if txn is None:
+            return retry(txnAbortOnError(self.appendDelta))(operation, item)
+
+        if not self.db.exists(self.db_key, txn=txn):
+            return False
+
+        self.deltaDb.put(self.db_key, self.toStorable((operation, item)), txn=txn)
+
+        cursor = self.deltaDb.cursor(txn=txn)
+        try:
+            cursor.set(self.db_key)
+            deltas = cursor.count()
+        finally:
+            cursor.close()
+
+        if deltas >= self.deltaThreshold:
+            self.compact(txn=txn)
+        return True
+
+    def applyDeltas(self, value, txn=None, write=False):
+        flags = 0
+        if write:
+            flags = db.DB_RMW
+
+        cursor = self.deltaDb.cursor(txn=txn)
+        try:
+            record = cursor.set(self.db_key, flags=flags)
+            while record is not None:
+                operation, self.item = self.fromStorable(record[1])
+                try:
+                    if operation == 'add':
+                        value = self.add_item(value)
+                    else:
+                        value = self.remove_item(value)
+                except Exception:
+                    logging.exception('skipped delta %s of %r which could not be applied' % (operation, self.item))
+                record = cursor.next_dup(flags=flags)
+        finally:
+            cursor.close()
+
+        return value
+
+    def compact(self, txn=None):
+        """Applies the delta records to the value and stores the result, which removes them"""
+        if txn is None:
+            return retry(txnAbortOnError(self.compact))()
+        self.alter(lambda value: value, txn=txn)
+
+    @classmethod
+    def compact_deltas(cls):
+        """Compacts every key which has delta records, each in its own txn
+
+        Returns the number of keys compacted"""
+        if cls.deltaDb is None:
+            return 0
+
+        keys = []
+        cursor = cls.deltaDb.cursor()
+        try:
+            record = cursor.first(dlen=0, doff=0)
+            while record is not None:
+                keys.append(record[0])
+                record = cursor.next_nodup(dlen=0, doff=0)
+        finally:
+            cursor.close()
+
+        for key in keys:
+            entry = cls(*cls.fromKeyStore(key))
+            retry(txnAbortOnError(entry.compact))()
+
+        return len(keys)
+
+    @snapshotRead
+    def get(self, txn=None, write=False):
+        if not self.deltaLog:
+            return super().get(txn=txn, write=write)
+        # Applying deltas changes the value, so a cached copy can't be used
+        value = self.getUncached(txn=txn, write=write)
+        return self.applyDeltas(value, txn=txn, write=write)
+
+    @classmethod
+    def valueReplaced(cls, dbKey, txn=None):
+        # The deltas were made against the old value, so they don't apply to the new one
+        if cls.deltaLog:
+            try:
+                cls.deltaDb.delete(dbKey, txn=txn)
+            except db.DBNotFoundError:
+                pass
+
+    @classmethod
+    def scannedValue(cls, key, value, txn):
+        # Read in the txn of the scan, so the deltas match the value they are applied to
+        if cls.deltaLog:
+            value = cls(*key).applyDeltas(value, txn=txn)
+        return value
+
     def addNoDB(self, item, resource):
         self.item = item
 
@@ -475,14 +2078,27 @@ class Container(Resource):
 
 
 class PandasDf(Container):
-    """Adds support for using Pandas Data Frames, as well as different ways to add items"""
+    """Adds support for using Pandas Data Frames, as well as different ways to add items
+
+    Set merge_keys to a tuple of column names to match rows on those columns with
+    vectorized index lookups, instead of calling conditional for every row"""
+    valueCodec = PickleCodec(outOfBand=pickle.HIGHEST_PROTOCOL >= 5)
+    merge_keys = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # The subclasses in this module don't need pandas until a user subclass exists
+        if cls.__module__ != __name__:
+            importPandas()
 
     def add_item(self, df):
-        if isinstance(self.item, pd.Series):
+        if self.merge_keys is not None and isinstance(self.item, (pd.Series, pd.DataFrame)):
+            output = self.mergeDf(df)
+        elif isinstance(self.item, pd.Series):
             if len(df.index) >= 1:
                 output = self.addSeries(df)
             else:
-                output = df.append(self.item, ignore_index=True)
+                output = pd.concat([df, self.itemFrame()], ignore_index=True)
         elif isinstance(self.item, pd.DataFrame):
             if len(df.index) >= 1:
                 output = self.addDf(df)
@@ -494,10 +2110,9 @@ class PandasDf(Container):
                   'with db type', self.__class__.__name__)
             output = df
 
-        try:
+        if hasattr(self, 'sortDf'):
             return self.sortDf(output)
-        except NameError:
-            return output
+        return output
 
     def addDf(self, df):
         self.item['exists'] = self.item.apply(self.checkExists, axis=1, args=(df,))
@@ -508,7 +2123,7 @@ class PandasDf(Container):
 
         updated = df.apply(self.updateExisting, axis=1, args=(exists,))
 
-        return updated.append(notExists, ignore_index=True).drop(columns='exists')
+        return pd.concat([updated, notExists], ignore_index=True).drop(columns='exists')
 
     def addSeries(self, df):
         exists = self.conditional(self.item, df).any()
@@ -516,7 +2131,40 @@ class PandasDf(Container):
         if exists:
             return df.apply(self.updateExisting, axis=1, args=(self.item,))
         else:
-            return df.append(self.item, ignore_index=True)
+            return pd.concat([df, self.itemFrame()], ignore_index=True)
+
+    def mergeDf(self, df):
+        """Upserts the item rows into df by merge_keys
+
+        Stored rows keep their position and are replaced by the item row with the same keys,
+        item rows with new keys are added at the end. Repeated keys in the item keep the last row."""
+        item = self.itemFrame().drop_duplicates(subset=list(self.merge_keys), keep='last')
+
+        if len(df.index) == 0:
+            return item.reset_index(drop=True)
+
+        storedKeys = self.keyIndex(df)
+        itemKeys = self.keyIndex(item)
+
+        # Position of the matching item row for each stored row, -1 when there is none
+        position = itemKeys.get_indexer(storedKeys)
+        replaced = position >= 0
+        new = ~itemKeys.isin(storedKeys)
+
+        output = pd.concat([df[~replaced], item.iloc[position[replaced]], item[new]],
+                           ignore_index=True)
+        order = np.concatenate([np.flatnonzero(~replaced),
+                                np.flatnonzero(replaced),
+                                len(df.index) + np.arange(new.sum())])
+        return output.iloc[np.argsort(order, kind='stable')].reset_index(drop=True)
+
+    def itemFrame(self):
+        if isinstance(self.item, pd.Series):
+            return self.item.to_frame().T.infer_objects()
+        return self.item
+
+    def keyIndex(self, df):
+        return pd.MultiIndex.from_frame(df[list(self.merge_keys)])
 
     def updateExisting(self, row, exists):
         exists['dupe'] = self.conditional(row, exists)
@@ -547,31 +2195,907 @@ class PandasDf(Container):
         return duplicate.any()
 
     def remove_item(self, df):
-        remove = self.conditional(self.item, df)
+        if self.merge_keys is None:
+            remove = self.conditional(self.item, df)
+        elif len(df.index) == 0:
+            remove = np.zeros(0, dtype=bool)
+        else:
+            remove = self.keyIndex(df).isin(self.keyIndex(self.itemFrame()))
         self.removed = df[remove]
         return df[~remove]
 
     def make_details(self):
         return pd.DataFrame()
 
+    def readColumns(self, dbKey, columns, txn=None):
+        """Returns columns of the frame stored under dbKey, or None when nothing is stored
 
-envOpened = False
+        Frames stored with ColumnarCodec only have the columns asked for read"""
+        header = self.readStored(0, 1, txn=txn, dbKey=dbKey)
+        if header is None:
+            return None
+        if header != COLUMNS_HEADER:
+            return self.fromStorable(self.db.get(dbKey, txn=txn))[list(columns)]
+        return ColumnarCodec.decodeColumns(
+            lambda offset, length: self.readStored(offset, length, txn=txn, dbKey=dbKey), columns)
+
+    def get_columns(self, columns, txn=None):
+        """Get only some columns of the frame, set valueCodec to a ColumnarCodec to not read the rest"""
+        if self.deltaLog:
+            return self.get(txn=txn)[list(columns)]
+        output = self.readColumns(self.db_key, columns, txn=txn)
+        if output is None:
+            return self.make().reindex(columns=list(columns))
+        return output
+
+
+class PartitionedPandasDf(PandasDf):
+    """Spreads the rows of each frame over a number of partition records
+
+    Rows are assigned by hashing their merge_keys columns, which must be set, so adding or
+    removing rows only reads and writes the partitions those rows fall into. Numeric key
+    columns are hashed as floats, so a key of 3 and 3.0 land in the same partition.
+    Partitions are stored under the key with the partition number appended, which needs
+    the ordered key codec to keep the partitions of a key next to each other."""
+    keyCodec = TupleKeyCodec
+    partitions = 16
+
+    def partitionKey(self, partition):
+        return self.toKeyStore(self.values + (str(partition),))
+
+    def splitDf(self, df):
+        """Returns a dict of partition number to the rows of df which belong in it"""
+        if len(df.index) == 0:
+            return {}
+        hashes = pd.util.hash_pandas_object(self.hashableKeys(df), index=False).to_numpy()
+        assignment = hashes % np.uint64(self.partitions)
+        return {int(partition): rows for partition, rows in df.groupby(assignment, sort=False)}
+
+    def hashableKeys(self, df):
+        """The merge_keys columns of df with every numeric column as float64
+
+        A Series item of only numbers becomes a frame of floats, so the dtype of a key
+        column can differ between the stored rows and the item rows matching them."""
+        keys = df[list(self.merge_keys)].infer_objects()
+        numeric = [column for column in keys.columns
+                   if pd.api.types.is_numeric_dtype(keys[column]) and not pd.api.types.is_bool_dtype(keys[column])]
+        if numeric:
+            keys = keys.astype({column: 'float64' for column in numeric})
+        return keys
+
+    def joinPartitions(self, frames):
+        if not frames:
+            return self.make()
+        output = pd.concat(frames, ignore_index=True)
+        if hasattr(self, 'sortDf'):
+            return self.sortDf(output)
+        return output
+
+    def get_partition(self, partition, txn=None, write=False):
+        flags = 0
+        if write:
+            flags = db.DB_RMW
+
+        out = self.db.get(self.partitionKey(partition), txn=txn, flags=flags)
 
+        if out is None:
+            return pd.DataFrame()
+
+        return self.fromStorable(out)
+
+    def get_columns(self, columns, txn=None):
+        if txn is None:
+            return retry(txnAbortOnError(self.get_columns))(columns)
+        frames = []
+        for partition in range(self.partitions):
+            df = self.readColumns(self.partitionKey(partition), columns, txn=txn)
+            if df is not None and len(df.index) > 0:
+                frames.append(df)
+        if not frames:
+            return self.make().reindex(columns=list(columns))
+        return pd.concat(frames, ignore_index=True)
+
+    def put_partition(self, partition, df, txn=None):
+        key = self.partitionKey(partition)
+        if df is None or len(df.index) == 0:
+            try:
+                self.db.delete(key, txn=txn)
+            except db.DBNotFoundError:
+                pass
+        else:
+            self.db.put(key, self.toStorable(df.reset_index(drop=True)), txn=txn)
+
+    def iter_partitions(self, txn=None, write=False):
+        """Lazily yields (partition, df) for each partition holding rows
+
+        Without a txn the reads run in their own txn, so a write to several partitions
+        committed in one txn is seen whole or not at all"""
+        ownTxn = txn is None
+        if ownTxn:
+            txn = getEnvTxn()
+
+        try:
+            for partition in range(self.partitions):
+                df = self.get_partition(partition, txn=txn, write=write)
+                if len(df.index) > 0:
+                    yield partition, df
+        except:
+            if ownTxn:
+                txn.abort()
+            raise
+
+        if ownTxn:
+            txn.commit()
+
+    @snapshotRead
+    def get(self, txn=None, write=False):
+        if txn is None:
+            # All the partitions in one txn, retried as their read locks can deadlock with writers
+            return retry(txnAbortOnError(self.get))(write=write)
+        return self.joinPartitions([df for partition, df in self.iter_partitions(txn=txn, write=write)])
+
+    def put(self, value, txn=None):
+        parts = {} if value is None else self.splitDf(value)
+        for partition in range(self.partitions):
+            self.put_partition(partition, parts.get(partition), txn=txn)
+
+    def add(self, item, txn=None):
+        """Adds item to the partitions its rows hash into
+
+        Returns the item, and the rows of the partitions which were changed"""
+        self.item = item
+        changed = []
+        for partition, rows in self.splitDf(self.itemFrame()).items():
+            self.item = rows
+            after = self.add_item(self.get_partition(partition, txn=txn, write=True))
+            self.put_partition(partition, after, txn=txn)
+            changed.append(after)
+
+        self.item = item
+        return self.item, self.joinPartitions(changed)
+
+    def remove(self, item, txn=None):
+        """Removes the rows matching item from the partitions they hash into
+
+        Returns the removed rows, and the rows of the partitions which were changed"""
+        self.item = item
+        removed = []
+        changed = []
+        for partition, rows in self.splitDf(self.itemFrame()).items():
+            self.item = rows
+            after = self.remove_item(self.get_partition(partition, txn=txn, write=True))
+            self.put_partition(partition, after, txn=txn)
+            removed.append(self.removed)
+            changed.append(after)
+
+        self.item = item
+        self.removed = pd.concat(removed, ignore_index=True) if removed else pd.DataFrame()
+        return self.removed, self.joinPartitions(changed)
 
-def createEnvWithDir(envPath):
+    @classmethod
+    def iter_items(cls, txn=None, prefix=(), batch=1000, snapshot=False):
+        """Yields each (key, df) pair, joining the partitions of each key"""
+        currentKey = None
+        frames = []
+        for key, df in super().iter_items(txn=txn, prefix=prefix, batch=batch, snapshot=snapshot):
+            if key[:-1] != currentKey:
+                if frames:
+                    yield currentKey, cls(*currentKey).joinPartitions(frames)
+                currentKey = key[:-1]
+                frames = []
+            frames.append(df)
+
+        if frames:
+            yield currentKey, cls(*currentKey).joinPartitions(frames)
+
+    @classmethod
+    def has_key(cls, k, txn=None, write=False):
+        flags = 0
+        if write:
+            flags = db.DB_RMW
+
+        resource = cls(*k)
+        return any(cls.db.exists(resource.partitionKey(partition), txn=txn, flags=flags)
+                   for partition in range(cls.partitions))
+
+    @classmethod
+    def sortedKeys(cls, keys):
+        """Key tuples as entry tuples in the order their partitions are stored"""
+        keys = [cls.keyToEntryTuple(key) for key in keys]
+        order = sorted(range(len(keys)), key=lambda index: cls.toKeyStore(keys[index]))
+        return keys, order
+
+    @classmethod
+    def put_many(cls, items, txn=None, chunk=10000, durability=None):
+        """Put each (key tuple, df) pair, chunk counts keys rather than partition records"""
+        items = list(items)
+        keys, order = cls.sortedKeys(key for key, value in items)
+
+        def putChunk(indexes, txn=None):
+            for index in indexes:
+                cls(*keys[index]).put(items[index][1], txn=txn)
+            return []
+
+        runChunked(putChunk, order, txn=txn, chunk=chunk, durability=durability)
+
+    @classmethod
+    def get_many(cls, keys, txn=None, write=False, chunk=10000):
+        keys, order = cls.sortedKeys(keys)
+
+        def getChunk(indexes, txn=None):
+            return [cls(*keys[index]).get(txn=txn, write=write) for index in indexes]
+
+        stored = runChunked(getChunk, order, txn=txn, chunk=chunk)
+
+        output = [None] * len(keys)
+        for index, value in zip(order, stored):
+            output[index] = value
+        return output
+
+    @classmethod
+    def delete_many(cls, keys, txn=None, chunk=10000):
+        keys, order = cls.sortedKeys(keys)
+
+        def deleteChunk(indexes, txn=None):
+            deleted = []
+            for index in indexes:
+                deleted.append(cls.has_key(keys[index], txn=txn, write=True))
+                cls(*keys[index]).put(None, txn=txn)
+            return deleted
+
+        removed = runChunked(deleteChunk, order, txn=txn, chunk=chunk)
+
+        output = [False] * len(keys)
+        for index, wasDeleted in zip(order, removed):
+            output[index] = wasDeleted
+        return output
+
+    @classmethod
+    def iter_keys(cls, txn=None, prefix=()):
+        currentKey = None
+        for key in super().iter_keys(txn=txn, prefix=prefix):
+            if key[:-1] != currentKey:
+                currentKey = key[:-1]
+                yield currentKey
+
+    @classmethod
+    def partitionsToKeys(cls, partitionKeys):
+        keys = []
+        for key in partitionKeys:
+            if not keys or keys[-1] != key[:-1]:
+                keys.append(key[:-1])
+        return keys
+
+    @classmethod
+    def db_keys(cls):
+        return cls.partitionsToKeys(super().db_keys())
+
+    @classmethod
+    def keysWithPrefix(cls, *args, txn=None):
+        return cls.partitionsToKeys(super().keysWithPrefix(*args, txn=txn))
+
+    @classmethod
+    def length(cls, fast=False, txn=None):
+        """Number of keys, this walks every partition key as the stats count partitions"""
+        return len(cls.db_keys())
+
+    @classmethod
+    def count_prefix(cls, *args, fast=False, txn=None):
+        if not args:
+            return cls.length(fast=fast, txn=txn)
+        return len(cls.keysWithPrefix(*args, txn=txn))
+
+
+class Sequence(Resource):
+    """A counter for each key, kept by BerkeleyDB's DB_SEQUENCE
+
+    Each process takes cacheSize values at a time from the stored record, so incr and
+    next_id only lock and write the record when that range runs out. Values left in a
+    cache when the process exits are skipped, so ids are unique and increasing but can
+    have gaps, and get returns this process's position. With cacheSize 0 every call
+    writes the record, and can then be part of a txn. Only incr creates a counter and
+    keeps its handle open, reading one opens a handle for just that read."""
+    cacheSize = 1000
+    initialValue = 0
+    sequences = None
+
+    @classmethod
+    def openExtraDbs(cls):
+        super().openExtraDbs()
+        cls.sequences = {}
+
+    @classmethod
+    def closeExtraDbs(cls):
+        if cls.sequences is not None:
+            for sequence in cls.sequences.values():
+                sequence.close()
+            cls.sequences = None
+        super().closeExtraDbs()
+
+    def sequence(self):
+        """The DBSequence handle of this key, opened on first use and shared between threads"""
+        # Looking up db opens the class when opening lazily, which sets sequences
+        self.db
+        sequence = self.sequences.get(self.db_key)
+        if sequence is None:
+            with openLock:
+                sequence = self.sequences.get(self.db_key)
+                if sequence is None:
+                    sequence = self.openSequence(create=True)
+                    self.sequences[self.db_key] = sequence
+        return sequence
+
+    def openSequence(self, create=False, txn=None):
+        """Opens a new DBSequence handle of this key, None when it doesn't exist and create isn't set"""
+        sequence = db.DBSequence(self.db)
+        if self.cacheSize:
+            sequence.set_cachesize(self.cacheSize)
+        sequence.initial_value(self.initialValue)
+        flags = db.DB_THREAD
+        if create:
+            flags = flags | db.DB_CREATE
+        try:
+            sequence.open(self.db_key, txn=txn, flags=flags)
+        except db.DBNotFoundError:
+            sequence.close()
+            return None
+        return sequence
+
+    @instrumented('incr')
+    def incr(self, n=1, txn=None):
+        """Adds n to the counter and returns its new value"""
+        if txn is not None and self.cacheSize:
+            raise ValueError('A cached sequence can not be used in a txn, set cacheSize to 0')
+        return self.sequence().get(n, txn=txn) + n
+
+    def next_id(self, txn=None):
+        """Returns a value which no other call for this key returns"""
+        return self.incr(txn=txn) - 1
+
+    def get(self, txn=None, write=False, snapshot=False):
+        """The current value of the counter as this process sees it, make() when it doesn't exist
+
+        With a cacheSize the stored value is the end of the cached range, so 'value',
+        the position of this handle, is used rather than 'current'. snapshot is accepted
+        for aget, the value is read from the handle either way."""
+        # Looking up db opens the class when opening lazily, which sets sequences
+        self.db
+        sequence = self.sequences.get(self.db_key)
+        if sequence is not None:
+            return sequence.stat()['value']
+
+        # Nothing was taken from the counter here, so its stored value is the position
+        sequence = self.openSequence(txn=txn)
+        if sequence is None:
+            return self.make()
+        try:
+            return sequence.stat()['value']
+        finally:
+            sequence.close()
+
+    def put(self, value, txn=None):
+        raise TypeError('Sequences can only be changed with incr')
+
+    def remove(self, txn=None):
+        """Deletes the counter"""
+        sequence = self.sequence()
+        del self.sequences[self.db_key]
+        sequence.remove(txn=txn)
+
+    @classmethod
+    def iter_items(cls, txn=None, prefix=(), batch=1000, snapshot=False):
+        # The stored records are BerkeleyDB's own, so the values come from the handles
+        for key in cls.iter_keys(txn=txn, prefix=prefix):
+            yield key, cls(*key).get()
+
+
+class QueueResource(Resource):
+    """A durable FIFO queue stored with DB_QUEUE
+
+    Subclasses set keys = ("Recno",), each record is keyed by the record number push
+    returned. Records have a fixed length of recordLength bytes, which has to fit the
+    encoded value and 4 bytes of its length. DB_QUEUE locks single records, so any
+    number of threads and processes can push and pop at once."""
+    DBTYPE = db.DB_QUEUE
+    recordLength = 1024
+    # Records per extent file, None keeps the whole queue in one file
+    extentSize = None
+
+    @classmethod
+    def configureDb(cls, handle):
+        super().configureDb(handle)
+        handle.set_re_len(cls.recordLength)
+        handle.set_re_pad(0)
+        if cls.extentSize is not None:
+            handle.set_q_extentsize(cls.extentSize)
+
+    @classmethod
+    def fromKeyStore(cls, key):
+        return (str(key),)
+
+    @classmethod
+    def toKeyStore(cls, key):
+        return int(key[0])
+
+    @classmethod
+    @instrumented('decode')
+    def fromStorable(cls, storable):
+        length, = struct.unpack_from('<I', storable)
+        return decodeValue(memoryview(storable)[4:4 + length])
+
+    @classmethod
+    @instrumented('encode')
+    def toStorable(cls, data):
+        stored = cls.valueCodec.encode(data)
+        if len(stored) + 4 > cls.recordLength:
+            raise ValueError('%s values can be at most %d bytes once encoded, this one is %d'
+                             % (cls.__name__, cls.recordLength - 4, len(stored)))
+        return struct.pack('<I', len(stored)) + stored
+
+    @classmethod
+    def push(cls, value, txn=None):
+        """Adds value to the tail of the queue, returns its record number"""
+        return cls.db.append(cls.toStorable(value), txn=txn)
+
+    @classmethod
+    def push_many(cls, values, txn=None, chunk=10000):
+        """Adds each of values to the queue in order, returns their record numbers"""
+        records = [cls.toStorable(value) for value in values]
+
+        def pushChunk(chunkRecords, txn=None):
+            return [cls.db.append(record, txn=txn) for record in chunkRecords]
+
+        return runChunked(pushChunk, records, txn=txn, chunk=chunk)
+
+    @classmethod
+    def pop(cls, blocking=False, timeout=None, txn=None):
+        """Removes the value at the head of the queue and returns it, None when there is none
+
+        blocking waits for a value to be pushed, for up to timeout seconds when it is set.
+        A value popped in a txn which is aborted goes back in the queue."""
+        if blocking:
+            record = cls.consumeWait(timeout, txn=txn)
+        else:
+            record = cls.db.consume(txn=txn)
+
+        if record is None:
+            return None
+
+        return cls.fromStorable(record[1])
+
+    @classmethod
+    def consumeWait(cls, timeout, txn=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            # Waits in a child txn, so a timeout doesn't abort the caller's txn
+            attempt = getEnvTxn(parent=txn)
+            if deadline is not None:
+                remaining = max(1, int((deadline - time.monotonic()) * 1000000))
+                # set_timeout takes a C int, so long timeouts wait in pieces until the deadline
+                attempt.set_timeout(min(remaining, MAX_TIMEOUT), db.DB_SET_LOCK_TIMEOUT)
+            try:
+                record = cls.db.consume_wait(txn=attempt)
+            except (db.DBLockNotGrantedError, db.DBLockDeadlockError):
+                attempt.abort()
+                if deadline is not None and time.monotonic() >= deadline:
+                    return None
+                continue
+            except:
+                attempt.abort()
+                raise
+            attempt.commit()
+            return record
+
+    @classmethod
+    def peek(cls, txn=None):
+        """Returns the value at the head of the queue without removing it, None when there is none"""
+        cursor = cls.getCursor(txn=txn)
+        try:
+            current = cursor.first()
+        finally:
+            cursor.close()
+        if current is None:
+            return None
+        return current[1]
+
+
+envOpened = False
+
+envDir = None
+
+envConfig = None
+
+GIGABYTE = 1 << 30
+MEGABYTE = 1 << 20
+
+# Largest timeout in microseconds the handles' set_timeout accepts, about 35 minutes
+MAX_TIMEOUT = 2 ** 31 - 1
+
+DURABILITY_FLAGS = {'sync': 0,
+                    'write_nosync': db.DB_TXN_WRITE_NOSYNC,
+                    'nosync': db.DB_TXN_NOSYNC}
+
+# Per txn durability, overriding the env's. 'group' commits without flushing, then waits
+# for the GroupCommit flush, so it is as durable as 'sync' once the commit returns. That
+# wait is done by commitTxn(txn, 'group') and txnAbortOnError(durability='group'), a
+# 'group' txn committed with txn.commit() is only as durable as 'nosync'
+TXN_DURABILITY = {'sync': db.DB_TXN_SYNC,
+                  'write_nosync': db.DB_TXN_WRITE_NOSYNC,
+                  'nosync': db.DB_TXN_NOSYNC,
+                  'group': db.DB_TXN_NOSYNC}
+
+
+class GroupCommit:
+    """Shares one log flush between the commits of many threads
+
+    commit commits the txn without flushing the log, then waits until a flush covers it.
+    A background thread flushes every interval seconds, or sooner once maxWaiting commits
+    are waiting, so each commit is still durable when it returns, but a flush to disk
+    is paid per group of commits instead of per commit. With wait=False commit returns
+    straight away, and the commit may be lost if the machine fails within interval."""
+
+    def __init__(self, interval=0.005, maxWaiting=64):
+        self.interval = interval
+        self.maxWaiting = maxWaiting
+        self.condition = threading.Condition()
+        self.committed = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.running = False
+        self.finished = False
+        self.thread = None
+
+    def start(self):
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+            self.finished = False
+        self.thread = threading.Thread(target=self.run, name='simpleBDB-group-commit', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stops the flush thread after a last flush of the waiting commits"""
+        with self.condition:
+            if not self.running:
+                return
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+        self.thread = None
+
+    def commit(self, txn, wait=True):
+        txn.commit(db.DB_TXN_NOSYNC)
+        with self.condition:
+            self.committed += 1
+            ticket = self.committed
+            # Wakes the flush thread when it is idle, or early once enough are waiting
+            if ticket - self.flushed == 1 or ticket - self.flushed >= self.maxWaiting:
+                self.condition.notify_all()
+            if not wait:
+                return
+            while self.flushed < ticket and not self.finished:
+                self.condition.wait()
+            if self.flushed >= ticket:
+                return
+        # The flush thread stopped before this commit, so flush it here
+        env.log_flush()
+
+    def run(self):
+        while True:
+            with self.condition:
+                # Idle until a commit comes in, then give others interval to join its flush
+                while self.running and self.committed == self.flushed:
+                    self.condition.wait()
+                if self.running and self.committed - self.flushed < self.maxWaiting:
+                    self.condition.wait(self.interval)
+                running = self.running
+                target = self.committed
+
+            if target > self.flushed:
+                env.log_flush()
+                with self.condition:
+                    self.flushed = target
+                    self.flushes += 1
+                    self.condition.notify_all()
+                if metrics.enabled:
+                    metrics.count('groupCommit.flushes')
+
+            if not running:
+                with self.condition:
+                    self.finished = True
+                    self.condition.notify_all()
+                return
+
+    def stats(self):
+        with self.condition:
+            return {'commits': self.committed,
+                    'flushes': self.flushes,
+                    'waiting': self.committed - self.flushed}
+
+
+groupCommit = None
+
+# Held while groupCommit is replaced, so racing first commits start only one
+groupCommitLock = threading.RLock()
+
+
+def enableGroupCommit(interval=0.005, maxWaiting=64):
+    """Starts the GroupCommit used by txns with durability='group'"""
+    global groupCommit
+    with groupCommitLock:
+        disableGroupCommit()
+        groupCommit = GroupCommit(interval=interval, maxWaiting=maxWaiting)
+        groupCommit.start()
+        return groupCommit
+
+
+def disableGroupCommit():
+    global groupCommit
+    with groupCommitLock:
+        if groupCommit is not None:
+            groupCommit.stop()
+            groupCommit = None
+
+
+def getGroupCommit():
+    with groupCommitLock:
+        if groupCommit is None:
+            return enableGroupCommit()
+        return groupCommit
+
+
+class Maintenance:
+    """Background thread which checkpoints, removes old logs, and breaks deadlocks
+
+    Each task runs every interval seconds, an interval of None turns it off.
+    checkpointKbytes and checkpointMinutes skip a checkpoint when less than that much
+    log or time has passed since the last one. compact runs DB.compact on every open
+    file, and compact_deltas on every delta logged Container. Removing logs stops them
+    being usable for catastrophic recovery, so take backups with doBackup."""
+
+    def __init__(self, checkpointInterval=60, checkpointKbytes=0, checkpointMinutes=0,
+                 logRemoveInterval=300, lockDetectInterval=1, lockDetectFlags=db.DB_LOCK_DEFAULT,
+                 compactInterval=None):
+        self.intervals = {'checkpoint': checkpointInterval,
+                          'logRemove': logRemoveInterval,
+                          'lockDetect': lockDetectInterval,
+                          'compact': compactInterval}
+        self.checkpointKbytes = checkpointKbytes
+        self.checkpointMinutes = checkpointMinutes
+        self.lockDetectFlags = lockDetectFlags
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+        self.nextRun = {}
+        self.runs = {task: 0 for task in self.intervals}
+        self.errors = 0
+        self.logsRemoved = 0
+        self.deadlocksBroken = 0
+        self.pagesFreed = 0
+
+    def start(self):
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        now = time.monotonic()
+        self.nextRun = {task: now + interval for task, interval in self.intervals.items()
+                        if interval is not None}
+        self.thread = threading.Thread(target=self.run, name='simpleBDB-maintenance', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            if not self.running:
+                return
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        while True:
+            with self.condition:
+                if self.running and self.nextRun:
+                    self.condition.wait(max(0, min(self.nextRun.values()) - time.monotonic()))
+                elif self.running:
+                    self.condition.wait()
+                if not self.running:
+                    return
+
+            now = time.monotonic()
+            for task, due in list(self.nextRun.items()):
+                if due <= now:
+                    self.runTask(task)
+                    self.nextRun[task] = time.monotonic() + self.intervals[task]
+
+    def runTask(self, task):
+        try:
+            getattr(self, task)()
+        except:
+            logging.exception('maintenance task %s failed' % task)
+            self.errors += 1
+            if metrics.enabled:
+                metrics.count('maintenance.errors')
+            return
+        self.runs[task] += 1
+        if metrics.enabled:
+            metrics.count('maintenance.' + task)
+
+    def checkpoint(self):
+        env.txn_checkpoint(self.checkpointKbytes, self.checkpointMinutes)
+
+    def logRemove(self):
+        # Asking for the names first is what lets us report how many were removed
+        removable = env.log_archive(0)
+        env.log_archive(db.DB_ARCH_REMOVE)
+        self.logsRemoved += len(removable)
+
+    def lockDetect(self):
+        aborted = env.lock_detect(self.lockDetectFlags)
+        if aborted:
+            self.deadlocksBroken += aborted
+
+    def compact(self):
+        for resource in DBS:
+            # Queues can't be compacted, their extent files are removed as they empty instead
+            if not resource.isOpen() or resource.DBTYPE == db.DB_QUEUE:
+                continue
+            result = resource.db.compact(flags=db.DB_FREE_SPACE)
+            self.pagesFreed += result['pages_free'] + result['pages_truncated']
+            if issubclass(resource, Container) and resource.deltaLog:
+                resource.compact_deltas()
+
+    def stats(self):
+        return {'running': self.running,
+                'runs': dict(self.runs),
+                'errors': self.errors,
+                'logsRemoved': self.logsRemoved,
+                'deadlocksBroken': self.deadlocksBroken,
+                'pagesFreed': self.pagesFreed}
+
+
+maintenance = None
+
+
+def startMaintenance(task=None, **kwargs):
+    """Starts task, or a Maintenance made with kwargs, in place of any running one"""
+    global maintenance
+    stopMaintenance()
+    if task is None:
+        task = Maintenance(**kwargs)
+    maintenance = task
+    maintenance.start()
+    return maintenance
+
+
+def stopMaintenance():
+    global maintenance
+    if maintenance is not None:
+        maintenance.stop()
+        maintenance = None
+
+
+class EnvConfig:
+    """Settings createEnvWithDir applies to the env before opening it
+
+    cacheBytes: Size of the mpool cache, split over cacheRegions regions
+    maxLocks, maxLockObjects, maxLockers: Sizes of the lock tables, None keeps the default
+    logBufferBytes: Size of the in memory log buffer, None keeps the default
+    durability: 'sync' flushes the log on every commit, 'write_nosync' writes it to the OS
+        without flushing, which can lose the last commits if the machine fails, and 'nosync'
+        doesn't write it on commit, which can lose them if the process fails
+    Timeouts are in microseconds. The defaults are what createEnvWithDir always used."""
+
+    def __init__(self, cacheBytes=GIGABYTE, cacheRegions=1, maxLocks=100000, maxLockObjects=100000,
+                 maxLockers=None, logBufferBytes=None, durability='sync', txnTimeout=5000000,
+                 lockTimeout=10000000, regTimeout=15000000):
+        if durability not in DURABILITY_FLAGS:
+            raise ValueError('durability should be one of: ' + ', '.join(DURABILITY_FLAGS))
+        self.cacheBytes = cacheBytes
+        self.cacheRegions = cacheRegions
+        self.maxLocks = maxLocks
+        self.maxLockObjects = maxLockObjects
+        self.maxLockers = maxLockers
+        self.logBufferBytes = logBufferBytes
+        self.durability = durability
+        self.txnTimeout = txnTimeout
+        self.lockTimeout = lockTimeout
+        self.regTimeout = regTimeout
+
+    def apply(self, dbEnv):
+        dbEnv.set_timeout(self.txnTimeout, flags=db.DB_SET_TXN_TIMEOUT)
+        dbEnv.set_timeout(self.lockTimeout, flags=db.DB_SET_LOCK_TIMEOUT)
+        dbEnv.set_timeout(self.regTimeout, flags=db.DB_SET_REG_TIMEOUT)
+        dbEnv.set_cachesize(self.cacheBytes // GIGABYTE, self.cacheBytes % GIGABYTE, self.cacheRegions)
+        if self.maxLocks is not None:
+            dbEnv.set_lk_max_locks(self.maxLocks)
+        if self.maxLockObjects is not None:
+            dbEnv.set_lk_max_objects(self.maxLockObjects)
+        if self.maxLockers is not None:
+            dbEnv.set_lk_max_lockers(self.maxLockers)
+        if self.logBufferBytes is not None:
+            dbEnv.set_lg_bsize(self.logBufferBytes)
+        if DURABILITY_FLAGS[self.durability]:
+            dbEnv.set_flags(DURABILITY_FLAGS[self.durability], 1)
+
+
+envProfiles = {
+    'default': EnvConfig(),
+    'small': EnvConfig(cacheBytes=64 * MEGABYTE, maxLocks=10000, maxLockObjects=10000),
+    'large': EnvConfig(cacheBytes=16 * GIGABYTE, cacheRegions=4, maxLocks=1000000,
+                       maxLockObjects=1000000, logBufferBytes=8 * MEGABYTE),
+}
+
+
+def dataSize(envPath):
+    """Total size of the database files in envPath, leaving out logs and env regions"""
+    total = 0
+    for name in os.listdir(envPath):
+        path = os.path.join(envPath, name)
+        if name.startswith('log.') or name.startswith('__db.') or not os.path.isfile(path):
+            continue
+        total += os.path.getsize(path)
+    return total
+
+
+def autoSizeConfig(envPath, base=None, hitRatioTarget=0.99, ramFraction=0.5,
+                   minCacheBytes=32 * MEGABYTE):
+    """Returns a copy of base with a cache size suited to the data in envPath
+
+    The cache is sized to hold the data files with some headroom. When the env is open and
+    its mpool hit ratio is under hitRatioTarget, the cache is grown to at least twice its
+    current size. The result is capped at ramFraction of the machine's memory."""
+    if base is None:
+        base = envProfiles['default']
+
+    cacheBytes = int(dataSize(envPath) * 1.25)
+
+    if env is not None and envDir is not None and os.path.samefile(envDir, envPath):
+        memp = env.memp_stat()
+        if isinstance(memp, tuple):
+            memp = memp[0]
+        lookups = memp['cache_hit'] + memp['cache_miss']
+        if lookups and memp['cache_hit'] / lookups < hitRatioTarget:
+            current = memp['gbytes'] * GIGABYTE + memp['bytes']
+            cacheBytes = max(cacheBytes, current * 2)
+
+    try:
+        ram = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        cacheBytes = min(cacheBytes, int(ram * ramFraction))
+    except (AttributeError, ValueError, OSError):
+        pass
+
+    cacheBytes = max(cacheBytes, minCacheBytes)
+
+    config = copy.copy(base)
+    config.cacheBytes = cacheBytes
+    # A region for every 4 GB, as BerkeleyDB handles smaller regions better
+    config.cacheRegions = max(1, -(-cacheBytes // (4 * GIGABYTE)))
+    return config
+
+
+def createEnvWithDir(envPath, config=None, maintenance=None):
     """creates the DBEnv using envPath, Must be called before using the DB
 
-    envPath: The directory where the db will be stored"""
+    envPath: The directory where the db will be stored
+    config: An EnvConfig, or the name of one of the envProfiles, the default profile if None
+    maintenance: A Maintenance to start once the env is open, True for the default one"""
+    global envDir, envConfig
 
     if not os.path.exists(envPath):
         os.makedirs(envPath)
 
-    env.set_timeout(5000000, flags=db.DB_SET_TXN_TIMEOUT)
-    env.set_timeout(10000000, flags=db.DB_SET_LOCK_TIMEOUT)
-    env.set_timeout(15000000, flags=db.DB_SET_REG_TIMEOUT)
-    env.set_cachesize(1, 0)
-    env.set_lk_max_locks(100000)
-    env.set_lk_max_objects(100000)
+    if config is None:
+        config = envProfiles['default']
+    elif isinstance(config, str):
+        config = envProfiles[config]
+
+    envDir = envPath
+    envConfig = config
+
+    config.apply(env)
 
     env.open(
         envPath,
@@ -581,4 +3105,179 @@ def createEnvWithDir(envPath):
         db.DB_INIT_TXN |
         db.DB_INIT_LOG |
         db.DB_CREATE |
-        db.DB_RECOVER)
\ No newline at end of file
+        db.DB_RECOVER)
+
+    if maintenance is True:
+        startMaintenance()
+    elif maintenance:
+        startMaintenance(maintenance)
+
+
+def joinEnvWithDir(envPath):
+    """Opens the env another process made with createEnvWithDir, without running recovery"""
+    global env, envDir
+    env = db.DBEnv()
+    env.open(envPath, db.DB_JOINENV | db.DB_THREAD)
+    envDir = envPath
+
+
+# The handles a forked process inherited. Deallocating a handle closes it, and closing the
+# parent's handles from a child corrupts the regions they share, so they are kept here for
+# the life of the process, which multiprocessing ends with os._exit
+inheritedHandles = []
+
+
+def forgetInheritedHandles():
+    """Stops a forked process using the handles it inherited, which only the parent may use"""
+    global env, maintenance, groupCommit
+    # Their threads weren't forked, only the objects
+    maintenance = None
+    groupCommit = None
+    if env is not None:
+        inheritedHandles.append(env)
+        env = None
+    for resource in DBS:
+        inheritedHandles.append(resource.ownHandle())
+        resource.forgetDB()
+        inheritedHandles.append(resource.indexDbs)
+        resource.indexDbs = None
+        if issubclass(resource, Container):
+            inheritedHandles.append(resource.deltaDb)
+            resource.deltaDb = None
+        if issubclass(resource, Sequence):
+            inheritedHandles.append(resource.sequences)
+            resource.sequences = None
+
+
+def splitKeyRange(resource, parts, txn=None):
+    """Returns up to parts - 1 keys which split resource into ranges of similar size
+
+    The boundaries are byte strings between the first and last stored keys, which need not
+    be stored keys themselves. Each is found by bisecting the 16 bytes after the prefix the
+    first and last keys share with key_range, so this costs up to about 128 key_range
+    calls per boundary instead of reading the keys."""
+    if parts < 2 or resource.DBTYPE != db.DB_BTREE:
+        return []
+
+    cursor = resource.db.cursor(txn=txn)
+    try:
+        first = cursor.first(dlen=0, doff=0)
+        last = cursor.last(dlen=0, doff=0)
+    finally:
+        cursor.close()
+
+    if first is None or first[0] == last[0]:
+        return []
+
+    first, last = first[0], last[0]
+    common = len(os.path.commonprefix([first, last]))
+    prefix = first[:common]
+    width = 16
+    low = int.from_bytes(first[common:common + width].ljust(width, b'\x00'), 'big')
+    high = int.from_bytes(last[common:common + width].ljust(width, b'\x00'), 'big')
+
+    boundaries = []
+    for part in range(1, parts):
+        target = part / parts
+        lower, upper = low, high
+        while upper - lower > 1:
+            middle = (lower + upper) // 2
+            less = resource.db.key_range(prefix + middle.to_bytes(width, 'big'), txn=txn)[0]
+            if less < target:
+                lower = middle
+            else:
+                upper = middle
+        boundary = prefix + upper.to_bytes(width, 'big')
+        if not boundaries or boundaries[-1] < boundary:
+            boundaries.append(boundary)
+
+    return boundaries
+
+
+def iterKeyRange(resource, start=None, end=None, batch=1000):
+    """Yields the decoded (key, value) pairs with a stored key from start up to, not including, end"""
+    cursor = resource.getCursor(bulk=True)
+    try:
+        if start is None:
+            records = cursor.nextRecords(count=batch)
+        else:
+            records = []
+            record = cursor.cursor.set_range(start)
+            if record is not None:
+                records.append(record)
+                records.extend(cursor.nextRecords(count=batch - 1))
+
+        while records:
+            if end is not None and records[-1][0] >= end:
+                yield from cursor.decodeRecords([record for record in records if record[0] < end])
+                return
+            yield from cursor.decodeRecords(records)
+            records = cursor.nextRecords(count=batch)
+    finally:
+        cursor.close()
+
+
+def scanKeyRange(envPath, resource, start, end, fn):
+    """Runs in a worker process, the env and DB are opened and closed around each scan"""
+    forgetInheritedHandles()
+    joinEnvWithDir(envPath)
+    resource.setDB()
+
+    scan = iterKeyRange(resource, start, end)
+    try:
+        items = scan
+        if getattr(resource, 'deltaLog', False):
+            items = ((key, resource(*key).applyDeltas(value)) for key, value in scan)
+        return fn(items)
+    finally:
+        scan.close()
+        resource.close()
+        env.close()
+
+
+def parallel_scan(resource, fn, workers=4, context=None):
+    """Scans resource with a pool of worker processes which join the same env
+
+    The keys are split into one range per worker, and fn is called in a worker with an
+    iterator of the (key, value) pairs of its range. Returns the output of fn for each
+    range, in key order. Records are read as stored, so the partitions of a
+    PartitionedPandasDf are separate items.
+
+    fn and the resource class are sent to workers by reference, so by default, where the
+    workers are spawned, they must be importable without side effects. A fork context
+    avoids that, but is only safe when no other thread holds a lock while forking."""
+    if resource.db is None:
+        raise DBNeverOpenedException
+    if envDir is None:
+        raise EnvNotCreatedException
+
+    if context is None:
+        import multiprocessing
+        context = multiprocessing.get_context('spawn')
+
+    boundaries = splitKeyRange(resource, workers)
+    ranges = list(zip([None] + boundaries, boundaries + [None]))
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=len(ranges), mp_context=context) as pool:
+        futures = [pool.submit(scanKeyRange, envDir, resource, start, end, fn)
+                   for start, end in ranges]
+        return [future.result() for future in futures]
+
+
+def reduceItems(mapper, reducer, initial, items):
+    return functools.reduce(reducer, (mapper(key, value) for key, value in items), initial)
+
+
+def map_reduce(resource, mapper, reducer, initial, workers=4, context=None, combine=None):
+    """Reduces mapper(key, value) for every record of resource across worker processes
+
+    Each worker reduces its own range starting from initial, so initial should be an empty
+    result such as 0 or [], which is then counted once per range. The partial results are
+    folded together with combine(partial, partial), which defaults to reducer for when the
+    mapped values and the results are the same type, such as with operator.add on numbers."""
+    if combine is None:
+        combine = reducer
+    partials = parallel_scan(resource, functools.partial(reduceItems, mapper, reducer, initial),
+                             workers=workers, context=context)
+    return functools.reduce(combine, partials)
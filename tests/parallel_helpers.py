@@ -0,0 +1,21 @@
+"""Resources and functions for the spawned workers of test_simpleBDB
+
+A spawned worker imports what it is sent by reference, which has to be a module it can
+import without creating the env again, unlike test_simpleBDB."""
+import simpleBDB as db
+
+
+class SpawnTest(db.Resource):
+    keys = ("First",)
+
+
+def spawnValue(key, value):
+    return value
+
+
+def countItems(items):
+    return sum(1 for item in items)
+
+
+def appendValue(values, value):
+    return values + [value]
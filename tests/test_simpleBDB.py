@@ -1,14 +1,21 @@
+import asyncio
+import multiprocessing
+import sys
 import threading
 import time
 
 import simpleBDB as db
+import operator
 import os
 import shutil
 import pandas as pd
+import pickle
 import pytest
 import berkeleydb
 import random
 
+import parallel_helpers
+
 testDir = 'testDb'
 
 if os.path.exists('testDb'):
@@ -454,6 +461,937 @@ def test_error_restart():
     otherTxn.commit()
 
 
+def test_tuple_key_codec():
+    keys = [('a',), ('a', 'b'), ('a', 'b\x00c'), ('a\x00',), ('ab',), ('b', ''), ('b', 'a')]
+
+    for key in keys:
+        assert db.TupleKeyCodec.decode(db.TupleKeyCodec.encode(key)) == key
+
+    assert sorted(keys, key=db.TupleKeyCodec.encode) == sorted(keys)
+
+    start, end = db.TupleKeyCodec.prefixRange(('a',))
+    inRange = [key for key in keys if start <= db.TupleKeyCodec.encode(key) < end]
+    assert inRange == [('a',), ('a', 'b'), ('a', 'b\x00c')]
+
+
+class OrderedKeyTest(db.Resource):
+    keys = ("First", "Second")
+    keyCodec = db.TupleKeyCodec
+
+
+def test_ordered_keys_which_match():
+    for first, second in [('a', 'b'), ('a', 'c'), ('ab', 'a'), ('b', 'a')]:
+        OrderedKeyTest(first, second).put(first + second)
+
+    assert OrderedKeyTest.keysWhichMatch('a') == [('a', 'b'), ('a', 'c')]
+    assert OrderedKeyTest.keysWhichMatch('a', 'c') == [('a', 'c')]
+    assert OrderedKeyTest.keysWhichMatch('c') == []
+    assert OrderedKeyTest('ab', 'a').get() == 'aba'
+    assert repr(OrderedKeyTest('a', 'b')) == 'OrderedKeyTest("(\'a\', \'b\')")'
+
+
+class MigrateKeyTest(db.Resource):
+    keys = ("First", "Second")
+
+
+def test_migrate_key_codec():
+    for first, second in [('b', 'a'), ('a', 'b'), ('a', 'c')]:
+        MigrateKeyTest(first, second).put(first + second)
+
+    MigrateKeyTest.keyCodec = db.TupleKeyCodec
+    assert db.migrateKeyCodec(MigrateKeyTest, db.PickleKeyCodec) == 3
+
+    assert MigrateKeyTest.db_key_tuples() == [('a', 'b'), ('a', 'c'), ('b', 'a')]
+    assert MigrateKeyTest.keysWhichMatch('a') == [('a', 'b'), ('a', 'c')]
+    assert MigrateKeyTest('b', 'a').get() == 'ba'
+
+
+def test_iter_items():
+    items = list(OrderedKeyTest.iter_items(prefix=('a',), batch=1))
+    assert items == [(('a', 'b'), 'ab'), (('a', 'c'), 'ac')]
+
+    assert OrderedKeyTest.all_dict() == {('a', 'b'): 'ab', ('a', 'c'): 'ac',
+                                         ('ab', 'a'): 'aba', ('b', 'a'): 'ba'}
+
+    # Unordered keys fall back to filtering the full scan
+    items = list(ResourceToTest.iter_items(prefix=('a',)))
+    assert items == [(('a', 'b'), 'testaltered')]
+
+    txn = db.getEnvTxn()
+    assert len(ResourceToTest.all(txn=txn)) == 1
+    txn.commit()
+
+
+class ScanLockTest(db.Resource):
+    keys = ("First",)
+
+
+def test_iter_items_read_committed():
+    ScanLockTest.put_many(((str(i),), 'x' * 1000) for i in range(2000))
+
+    # Without a txn the scan doesn't keep a read lock on every page it has passed
+    items = ScanLockTest.iter_items(batch=10)
+    for i in range(1990):
+        next(items)
+    assert db.stats()['lock']['nlocks'] < 50
+    assert len(list(items)) == 10
+
+
+def test_cursor_batches():
+    txn = db.getEnvTxn()
+    cursor = CursorTest.getCursor(txn=txn, bulk=True)
+
+    first = cursor.next_batch(3)
+    assert [key for key, value in first] == [('1',), ('2',), ('3',)]
+
+    rest = [record for batch in cursor.iter_batches(buffer_bytes=1) for record in batch]
+    assert len(first) + len(rest) == len(CursorTest.db_keys())
+    assert cursor.next_batch(3) == []
+
+    cursor.close()
+    txn.commit()
+
+
+class ManyTest(db.Resource):
+    keys = ("First", "Second")
+
+    def make_details(self):
+        return 'missing'
+
+
+def test_many():
+    ManyTest.put_many([(('b', str(i)), i) for i in range(25)] + [(('a', 'a'), 'first')], chunk=10)
+
+    # Nothing has counted the DB in full yet, so the fast count does it
+    assert ManyTest.length(fast=True) == 26
+    assert ManyTest.length() == 26
+    assert ManyTest('b', '7').get() == 7
+
+    keys = [('b', '3'), ('c', 'c'), ('a', 'a'), ('b', '20')]
+    assert ManyTest.get_many(keys, chunk=2) == [3, 'missing', 'first', 20]
+
+    txn = db.getEnvTxn()
+    assert ManyTest.delete_many([('a', 'a'), ('c', 'c')], txn=txn) == [True, False]
+    ManyTest.put_many([(('b', '3'), None), (('b', '4'), 'four')], txn=txn)
+    txn.commit()
+
+    assert ManyTest.get_many([('a', 'a'), ('b', '3'), ('b', '4')]) == ['missing', 'missing', 'four']
+    assert ManyTest.length() == 24
+
+
+def test_count_prefix():
+    assert OrderedKeyTest.length() == 4
+    assert OrderedKeyTest.count_prefix('a') == 2
+    assert OrderedKeyTest.count_prefix('a', 'c') == 1
+    assert OrderedKeyTest.count_prefix('c') == 0
+    assert OrderedKeyTest.count_prefix() == 4
+    assert 0 <= OrderedKeyTest.count_prefix('a', fast=True) <= 4
+
+    assert ManyTest.count_prefix('b') == 24
+
+
+def test_value_codecs():
+    frame = pd.DataFrame({'test': range(1000), 'otherVal': ['val'] * 1000})
+    codecs = [db.PickleCodec(), db.PickleCodec(outOfBand=True),
+              db.ZlibCodec(db.PickleCodec(outOfBand=True), threshold=100),
+              db.LzmaCodec(threshold=100)]
+
+    for codec in codecs:
+        assert db.decodeValue(codec.encode(frame)).equals(frame)
+
+    assert db.ZlibCodec(threshold=100).encode('small')[:1] == db.PICKLE_HEADER
+    assert db.JsonCodec().encode({'a': [1]})[:1] == db.JSON_HEADER
+
+    # Records written before the header byte existed
+    assert db.decodeValue(pickle.dumps({'old': 'record'}, 1)) == {'old': 'record'}
+
+
+class JsonTest(db.Resource):
+    keys = ("First",)
+    valueCodec = db.JsonCodec()
+
+
+def test_resource_value_codec():
+    JsonTest('a').put({'list': [1, 2], 'str': 'val'})
+    assert JsonTest('a').get() == {'list': [1, 2], 'str': 'val'}
+
+    # Switching codecs keeps old records readable
+    JsonTest.valueCodec = db.ZlibCodec(threshold=0)
+    JsonTest('b').put(['compressed'])
+    assert JsonTest.all_dict() == {('a',): {'list': [1, 2], 'str': 'val'}, ('b',): ['compressed']}
+
+
+class pandasMergeTest(db.PandasDf):
+    keys = ("First", "Second")
+    merge_keys = ('test',)
+
+    def sortDf(self, df):
+        return df.sort_values('test', ignore_index=True)
+
+
+def testPandasDfMergeKeys():
+    dfTest = pandasMergeTest('a', 'b')
+
+    toAdd = [pd.Series({'test': 1, 'otherVal': 'test'}),
+             pd.Series({'test': 0, 'otherVal': 'test0'}),
+             pd.Series({'test': 0, 'otherVal': 'updatedWithSeries'}),
+             pd.DataFrame({'test': [1, 2, 3], 'otherVal': ['updatedWithDf', 'test2', 'test3']})]
+
+    for item in toAdd:
+        txn = db.getEnvTxn()
+        dfTest.add(item, txn=txn)
+        txn.commit()
+
+    afterAdd = dfTest.get()
+    assert list(afterAdd['test']) == [0, 1, 2, 3]
+    assert list(afterAdd['otherVal']) == ['updatedWithSeries', 'updatedWithDf', 'test2', 'test3']
+
+    txn = db.getEnvTxn()
+    removed, afterRemove = dfTest.remove(pd.DataFrame({'test': [2, 5]}), txn=txn)
+    txn.commit()
+
+    assert list(removed['test']) == [2]
+    assert list(afterRemove['test']) == [0, 1, 3]
+
+
+class partitionTest(db.PartitionedPandasDf):
+    keys = ("First",)
+    merge_keys = ('test',)
+    partitions = 4
+
+    def sortDf(self, df):
+        return df.sort_values('test', ignore_index=True)
+
+
+def testPartitionedPandasDf():
+    dfTest = partitionTest('a')
+    assert len(dfTest.get().index) == 0
+
+    txn = db.getEnvTxn()
+    dfTest.add(pd.DataFrame({'test': range(20), 'otherVal': 'initial'}), txn=txn)
+    txn.commit()
+
+    partitionKeys = db.Resource.db_keys.__func__(partitionTest)
+    assert 1 < len(partitionKeys) <= 4
+
+    txn = db.getEnvTxn()
+    item, changed = dfTest.add(pd.Series({'test': 3, 'otherVal': 'updated'}), txn=txn)
+    txn.commit()
+
+    # Only the partition holding the row was rewritten
+    assert len(changed.index) < 20
+
+    afterAdd = dfTest.get()
+    assert list(afterAdd['test']) == list(range(20))
+    assert afterAdd.iloc[3]['otherVal'] == 'updated'
+
+    txn = db.getEnvTxn()
+    removed, changed = dfTest.remove(pd.DataFrame({'test': [3, 4]}), txn=txn)
+    txn.commit()
+
+    assert sorted(removed['test']) == [3, 4]
+    assert len(dfTest.get().index) == 18
+
+    # A Series of only numbers becomes a float row, which still finds the stored int key
+    txn = db.getEnvTxn()
+    dfTest.add(pd.Series({'test': 5, 'otherVal': 1.5}), txn=txn)
+    txn.commit()
+
+    afterFloat = dfTest.get()
+    assert len(afterFloat.index) == 18
+    assert list(afterFloat.loc[afterFloat['test'] == 5, 'otherVal']) == [1.5]
+
+    txn = db.getEnvTxn()
+    removed, changed = dfTest.remove(pd.DataFrame({'test': [6.0]}), txn=txn)
+    txn.commit()
+
+    assert list(removed['test']) == [6]
+    assert len(dfTest.get().index) == 17
+
+    assert partitionTest.keysWhichMatch('a') == [('a',)]
+    assert list(partitionTest.all_dict()) == [('a',)]
+    assert partitionTest.length() == 1
+    assert list(partitionTest.iter_keys()) == [('a',)]
+
+
+def test_partitioned_many():
+    assert partitionTest.has_key(('a',))
+    assert not partitionTest.has_key(('b',))
+
+    partitionTest.put_many([(('b',), pd.DataFrame({'test': range(10), 'otherVal': 'many'}))])
+    assert partitionTest.has_key(('b',))
+
+    b, missing = partitionTest.get_many([('b',), ('c',)])
+    assert list(b['test']) == list(range(10))
+    assert len(missing.index) == 0
+
+    assert partitionTest.delete_many([('b',), ('c',)]) == [True, False]
+    assert not partitionTest.has_key(('b',))
+    assert list(partitionTest.all_dict()) == [('a',)]
+
+
+class deltaTest(containerTest):
+    deltaLog = True
+    deltaThreshold = 3
+
+
+def countDeltas(key):
+    return len([k for k in deltaTest.deltaDb.keys() if k == deltaTest(*key).db_key])
+
+
+def test_container_delta_log():
+    testContainer = deltaTest('a', 'b')
+
+    # The first add has no value to apply a delta to, so it is written directly
+    item, after = testContainer.add('first')
+    assert after == ['first']
+    assert countDeltas(('a', 'b')) == 0
+
+    item, after = testContainer.add('second')
+    assert after is None
+    assert countDeltas(('a', 'b')) == 1
+
+    txn = db.getEnvTxn()
+    testContainer.remove('first', txn=txn)
+    txn.commit()
+
+    assert testContainer.get() == ['second']
+    assert deltaTest.all_dict() == {('a', 'b'): ['second']}
+    assert dict(deltaTest.iter_items(snapshot=True)) == {('a', 'b'): ['second']}
+
+    # Deltas are read in the txn of the scan, so uncommitted ones of that txn are seen
+    txn = db.getEnvTxn()
+    testContainer.add('pending', txn=txn)
+    assert dict(deltaTest.iter_items(txn=txn)) == {('a', 'b'): ['second', 'pending']}
+    txn.abort()
+
+    # Reaching the threshold compacts the deltas into the value
+    testContainer.add('third')
+    assert countDeltas(('a', 'b')) == 0
+    assert testContainer.get() == ['second', 'third']
+
+    testContainer.add('fourth')
+    assert deltaTest.compact_deltas() == 1
+    assert countDeltas(('a', 'b')) == 0
+    assert testContainer.get() == ['second', 'third', 'fourth']
+
+
+def addDelta(key):
+    testContainer = deltaTest(*key)
+    testContainer.add('old')
+    testContainer.add('delta')
+    assert countDeltas(key) == 1
+
+
+def test_delta_log_replaced_values():
+    # Writes which replace the whole value drop the deltas made against the old one
+    addDelta(('c', 'a'))
+    deltaTest.put_many([(('c', 'a'), ['new'])])
+    assert countDeltas(('c', 'a')) == 0
+    assert deltaTest('c', 'a').get() == ['new']
+
+    addDelta(('c', 'b'))
+    assert deltaTest.delete_many([('c', 'b')]) == [True]
+    assert countDeltas(('c', 'b')) == 0
+    deltaTest('c', 'b').add('fresh')
+    assert deltaTest('c', 'b').get() == ['fresh']
+
+    addDelta(('c', 'c'))
+    txn = db.getEnvTxn()
+    cursor = deltaTest.getCursor(txn=txn)
+    key, value = cursor.getWithKey(('c', 'c'))
+    assert key == ('c', 'c')
+    cursor.put(key, ['new'])
+    cursor.close()
+    txn.commit()
+    assert countDeltas(('c', 'c')) == 0
+    assert deltaTest('c', 'c').get() == ['new']
+
+    addDelta(('c', 'd'))
+    txn = db.getEnvTxn()
+    cursor = deltaTest.getCursor(txn=txn)
+    cursor.getWithKey(('c', 'd'))
+    cursor.delete()
+    cursor.close()
+    txn.commit()
+    assert countDeltas(('c', 'd')) == 0
+    assert deltaTest('c', 'd').get() == []
+
+
+def test_delta_log_failed_delta():
+    testContainer = deltaTest('d', 'a')
+    testContainer.add('kept')
+
+    # Removing a missing item can't fail the remove, so reads and compaction skip it
+    assert testContainer.remove('missing') == (None, None)
+    assert testContainer.get() == ['kept']
+
+    testContainer.add('second')
+    assert testContainer.get() == ['kept', 'second']
+
+    # The third delta reaches deltaThreshold, and the compaction drops the failed one
+    testContainer.add('third')
+    assert countDeltas(('d', 'a')) == 0
+    assert testContainer.get() == ['kept', 'second', 'third']
+
+
+class MigrateDeltaTest(containerTest):
+    deltaLog = True
+    deltaThreshold = 10
+
+
+def test_migrate_key_codec_deltas():
+    testContainer = MigrateDeltaTest('a', 'b')
+    testContainer.add('first')
+    testContainer.add('second')
+
+    MigrateDeltaTest.keyCodec = db.TupleKeyCodec
+    assert db.migrateKeyCodec(MigrateDeltaTest, db.PickleKeyCodec) == 1
+
+    # The pending delta moved to the new key along with the value
+    assert list(MigrateDeltaTest.deltaDb.keys()) == [MigrateDeltaTest('a', 'b').db_key]
+    assert MigrateDeltaTest('a', 'b').get() == ['first', 'second']
+
+
+class CacheTest(db.Resource):
+    keys = ("First",)
+    cache = db.ReadCache(maxEntries=2)
+
+
+def test_read_cache():
+    for key in ['a', 'b', 'c']:
+        CacheTest(key).put(key)
+
+    assert CacheTest('a').get() == 'a'
+    assert CacheTest('a').get() == 'a'
+    assert CacheTest.cache.stats()['hits'] == 1
+    assert CacheTest.cache.stats()['misses'] == 1
+
+    # Reads in a txn skip the cache, so they see the txn's own writes
+    txn = db.getEnvTxn()
+    CacheTest('a').put('changed', txn=txn)
+    assert CacheTest('a').get(txn=txn) == 'changed'
+    txn.commit()
+
+    assert CacheTest('a').get() == 'changed'
+
+    CacheTest('b').get()
+    CacheTest('c').get()
+    stats = CacheTest.cache.stats()
+    assert stats['entries'] == 2
+    assert stats['hits'] == 1
+
+    CacheTest('c').put(None)
+    assert CacheTest('c').get() is None
+
+
+class IndexTest(db.Resource):
+    keys = ("First",)
+    indexes = {'color': lambda value: value.get('color')}
+
+
+def test_secondary_index():
+    IndexTest('a').put({'color': 'red'})
+    IndexTest('b').put({'color': 'blue'})
+    IndexTest('c').put({'color': 'red'})
+    IndexTest('d').put({'shape': 'square'})
+
+    assert IndexTest.find_by('color', 'red') == [(('a',), {'color': 'red'}), (('c',), {'color': 'red'})]
+    assert IndexTest.find_by('color', 'green') == []
+
+    txn = db.getEnvTxn()
+    IndexTest('a').put({'color': 'green'}, txn=txn)
+    IndexTest('b').put(None, txn=txn)
+    txn.commit()
+
+    assert IndexTest.find_by('color', 'red') == [(('c',), {'color': 'red'})]
+    assert IndexTest.find_by('color', 'green') == [(('a',), {'color': 'green'})]
+    assert IndexTest.find_by('color', 'blue') == []
+
+    with pytest.raises(ValueError):
+        IndexTest.find_by('shape', 'square')
+
+    # The index keys are tagged with their type
+    IndexTest('e').put({'color': 1})
+    assert IndexTest.find_by('color', 1) == [(('e',), {'color': 1})]
+    assert IndexTest.find_by('color', '1') == []
+
+
+class IndexDeltaTest(containerTest):
+    deltaLog = True
+    indexes = {'size': len}
+
+
+def test_secondary_index_deltas():
+    testContainer = IndexDeltaTest('a', 'b')
+    testContainer.add('x')
+    testContainer.add('y')
+
+    # Indexed by the stored value, and returned with the deltas applied
+    assert IndexDeltaTest.find_by('size', 1) == [(('a', 'b'), ['x', 'y'])]
+
+
+class AsyncTest(db.Resource):
+    keys = ("First",)
+
+
+def test_async():
+    async def run():
+        await AsyncTest('a').aput(1)
+        assert await AsyncTest('a').aget() == 1
+
+        async with db.atxn() as txn:
+            await AsyncTest('b').aput(2, txn=txn)
+            await AsyncTest('a').aalter(lambda value: value + 10, txn=txn)
+
+        with pytest.raises(ValueError):
+            async with db.atxn() as txn:
+                await AsyncTest('c').aput(3, txn=txn)
+                raise ValueError
+
+        items = [item async for item in AsyncTest.aiter(batch=1)]
+        assert items == [(('a',), 11), (('b',), 2)]
+
+        cursor = await AsyncTest.agetCursor(bulk=True)
+        assert len(await cursor.anext_batch(5)) == 2
+        await cursor.aclose()
+
+    asyncio.run(run())
+
+
+class ParallelTest(db.Resource):
+    keys = ("First",)
+
+
+def parallelValue(key, value):
+    return value
+
+
+def countItems(items):
+    return sum(1 for item in items)
+
+
+def test_parallel_scan():
+    ParallelTest.put_many([((str(i),), i) for i in range(500)])
+
+    boundaries = db.splitKeyRange(ParallelTest, 4)
+    assert boundaries == sorted(boundaries)
+
+    # Spawned workers would import this module, which recreates the env
+    fork = multiprocessing.get_context('fork')
+    counts = db.parallel_scan(ParallelTest, countItems, workers=4, context=fork)
+    assert sum(counts) == 500
+
+    total = db.map_reduce(ParallelTest, parallelValue, operator.add, 0, workers=3, context=fork)
+    assert total == sum(range(500))
+
+    # A result of another type than the mapped values is folded with combine
+    values = db.map_reduce(ParallelTest, parallelValue, parallel_helpers.appendValue, [],
+                           workers=3, context=fork, combine=operator.add)
+    assert sorted(values) == list(range(500))
+
+
+def test_parallel_scan_spawn():
+    parallel_helpers.SpawnTest.put_many([((str(i),), i) for i in range(200)])
+
+    # The default spawns the workers, which import what they run from parallel_helpers
+    counts = db.parallel_scan(parallel_helpers.SpawnTest, parallel_helpers.countItems, workers=2)
+    assert sum(counts) == 200
+
+    values = db.map_reduce(parallel_helpers.SpawnTest, parallel_helpers.spawnValue,
+                           parallel_helpers.appendValue, [], workers=2, combine=operator.add)
+    assert sorted(values) == list(range(200))
+
+
+def test_metrics():
+    db.metrics.reset()
+    CursorTest('1').get()
+    assert db.metrics.snapshot()['histograms'] == {}
+
+    db.enableMetrics()
+    try:
+        CursorTest('1').put(1)
+        CursorTest('1').get()
+        ResourceToTest.all()
+
+        @db.txnAbortOnError
+        def wrapped(txn=None):
+            CursorTest('2').get(txn=txn)
+
+        wrapped()
+    finally:
+        db.enableMetrics(False)
+
+    snapshot = db.metrics.snapshot()
+    assert snapshot['histograms']['CursorTest.get']['count'] == 1
+    assert snapshot['histograms']['CursorTest.put']['count'] == 1
+    assert snapshot['histograms']['CursorTest.encode']['count'] == 1
+    assert snapshot['histograms']['ResourceToTest.cursor.batch']['count'] >= 1
+    assert snapshot['counters']['txn.commit'] == 2
+
+    envStats = db.stats()
+    for section in ['metrics', 'caches', 'memp', 'lock', 'log', 'txn']:
+        assert section in envStats
+
+
+class PageSizeTest(db.Resource):
+    keys = ("First",)
+    pageSize = 4096
+
+
+def test_env_config():
+    assert PageSizeTest.db.stat()['pagesize'] == 4096
+
+    with pytest.raises(ValueError):
+        db.EnvConfig(durability='sometimes')
+
+    config = db.autoSizeConfig(testDir, base=db.envProfiles['small'])
+    assert config.cacheBytes >= 32 * db.MEGABYTE
+    assert config.cacheRegions >= 1
+    assert config.maxLocks == db.envProfiles['small'].maxLocks
+
+
+class SnapshotTest(db.Resource):
+    keys = ("First",)
+    multiversion = True
+
+
+def test_snapshot_reads():
+    SnapshotTest('a').put('old')
+
+    reader = db.snapshot_txn()
+    assert SnapshotTest('a').get(txn=reader) == 'old'
+
+    # The reader holds no read locks, so this doesn't wait on it
+    txn = db.getEnvTxn()
+    SnapshotTest('a').put('new', txn=txn)
+    SnapshotTest('b').put('new', txn=txn)
+    txn.commit()
+
+    assert SnapshotTest('a').get(txn=reader) == 'old'
+    cursor = SnapshotTest.getCursor(txn=reader, snapshot=True)
+    assert cursor.next() == (('a',), 'old')
+    assert cursor.next() is None
+    cursor.close()
+    reader.commit()
+
+    assert SnapshotTest('a').get(snapshot=True) == 'new'
+
+    items = SnapshotTest.iter_items(snapshot=True)
+    assert next(items) == (('a',), 'new')
+    SnapshotTest('c').put('during scan')
+    assert list(items) == [(('b',), 'new')]
+
+    assert SnapshotTest.all_dict(snapshot=True) == {('a',): 'new', ('b',): 'new', ('c',): 'during scan'}
+
+
+class DurabilityTest(db.Resource):
+    keys = ("First",)
+
+
+def test_durability():
+    txn = db.getEnvTxn(durability='nosync')
+    DurabilityTest('nosync').put(1, txn=txn)
+    db.commitTxn(txn)
+
+    @db.txnAbortOnError(durability='write_nosync')
+    def putWriteNoSync(txn=None):
+        DurabilityTest('write_nosync').put(2, txn=txn)
+
+    putWriteNoSync()
+
+    DurabilityTest.put_many([(('many',), 3)], durability='nosync')
+
+    groupCommit = db.enableGroupCommit(interval=0.01)
+
+    def putGroup(key, txn=None):
+        DurabilityTest(key).put(key, txn=txn)
+
+    putGroupCommitted = db.retry(db.txnAbortOnError(putGroup, durability='group'))
+    threads = [threading.Thread(target=putGroupCommitted, args=(str(i),)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    groupStats = db.stats()['groupCommit']
+    assert groupStats['commits'] == 20
+    assert 1 <= groupStats['flushes'] <= 20
+    assert groupStats['waiting'] == 0
+    db.disableGroupCommit()
+    assert not groupCommit.running
+    assert 'groupCommit' not in db.stats()
+
+    # Racing first group commits start one GroupCommit between them
+    started = []
+    threads = [threading.Thread(target=lambda: started.append(db.getGroupCommit())) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(map(id, started))) == 1
+    assert started[0].running
+    db.disableGroupCommit()
+
+    assert DurabilityTest('nosync').get() == 1
+    assert DurabilityTest('write_nosync').get() == 2
+    assert DurabilityTest('many').get() == 3
+    assert DurabilityTest('19').get() == '19'
+
+
+def test_maintenance():
+    maintenance = db.startMaintenance(checkpointInterval=0.01, logRemoveInterval=0.01,
+                                      lockDetectInterval=0.01, compactInterval=0.01)
+    assert maintenance.running
+
+    deadline = time.time() + 10
+    while time.time() < deadline and not all(maintenance.runs.values()):
+        time.sleep(0.01)
+
+    maintenanceStats = db.stats()['maintenance']
+    assert all(count > 0 for count in maintenanceStats['runs'].values())
+    assert maintenanceStats['errors'] == 0
+    assert maintenanceStats['pagesFreed'] >= 0
+
+    db.stopMaintenance()
+    assert not maintenance.running
+    assert 'maintenance' not in db.stats()
+
+    # Closing the DB's stops a compact from running on closed handles
+    maintenance = db.startMaintenance(compactInterval=0.01)
+    db.close_dbs()
+    assert not maintenance.running
+    assert 'maintenance' not in db.stats()
+    db.open_dbs()
+
+
+class LazyTest(db.Resource):
+    keys = ("First",)
+
+
+def test_lazy_open():
+    # Defining the PandasDf subclasses above is what imported pandas
+    assert sys.modules['simpleBDB.db'].pd is pd
+
+    LazyTest.close()
+    assert not LazyTest.isOpen()
+    assert LazyTest.db is None
+
+    db.open_dbs(lazy=True)
+    threads = [threading.Thread(target=LazyTest(str(i)).put, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert LazyTest.isOpen()
+    assert LazyTest('3').get() == 3
+
+    LazyTest.close()
+    db.prewarm([LazyTest])
+    assert LazyTest.isOpen()
+    assert len(LazyTest.all()) == 8
+
+
+class LazySubTest(LazyTest):
+    pass
+
+
+def test_lazy_open_subclass():
+    # The parent being open must not hand its file to the subclass
+    assert LazyTest.isOpen()
+    LazySubTest.close()
+    assert not LazySubTest.isOpen()
+
+    db.open_dbs(lazy=True)
+    LazySubTest('sub').put('sub')
+
+    assert LazySubTest.isOpen()
+    assert LazySubTest.db is not LazyTest.db
+    assert LazySubTest.db_key_tuples() == [('sub',)]
+    assert not LazyTest.has_key(('sub',))
+
+
+class KeyOnlyTest(db.Resource):
+    keys = ("First", "Second")
+
+
+def test_key_only_scans():
+    for first in ('a', 'b'):
+        for second in range(3):
+            KeyOnlyTest(first, second).put('x' * 100000)
+
+    cursor = KeyOnlyTest.getCursor(keysOnly=True)
+    assert cursor.first() == (('a', '0'), None)
+    assert cursor.next() == (('a', '1'), None)
+    assert cursor.current() == (('a', '1'), None)
+    assert cursor.next_batch(10) == [(('a', '2'), None), (('b', '0'), None),
+                                     (('b', '1'), None), (('b', '2'), None)]
+    cursor.close()
+
+    assert list(KeyOnlyTest.iter_keys(prefix=('b',))) == [('b', '0'), ('b', '1'), ('b', '2')]
+    assert len(KeyOnlyTest.db_keys()) == 6
+    assert KeyOnlyTest.keysWithPrefix('a') == [('a', '0'), ('a', '1'), ('a', '2')]
+    assert KeyOnlyTest.keysWhichMatch('b', '1') == [('b', '1')]
+    assert KeyOnlyTest.count_prefix('b') == 3
+
+
+class BytesTest(db.Resource):
+    keys = ("First",)
+    valueCodec = db.BytesCodec()
+
+
+class ColumnsTest(db.PandasDf):
+    keys = ("First",)
+    valueCodec = db.ColumnarCodec()
+
+
+def test_large_values():
+    data = bytes(range(256)) * 8192
+    BytesTest('blob').put(data)
+
+    assert BytesTest('blob').get() == data
+    assert BytesTest('blob').get_range(1000, 10) == data[1000:1010]
+    assert BytesTest('missing').get_range(0, 10) is None
+
+    BytesTest('blob').put_range(5, b'hello')
+    assert BytesTest('blob').get_range(0, 12) == data[:5] + b'hello' + data[10:12]
+
+    chunks = list(BytesTest('blob').iter_bytes(chunk=100000))
+    assert len(chunks) == 21
+    assert b''.join(chunks) == data[:5] + b'hello' + data[10:]
+
+    df = pd.DataFrame({'a': [1, 2, 3], 'b': ['x', 'y', 'z'], 'c': [0.5, 1.5, 2.5]}, index=[3, 4, 5])
+    ColumnsTest('frame').put(df)
+
+    assert ColumnsTest('frame').get().equals(df)
+    assert ColumnsTest('frame').get_columns(['c', 'a']).equals(df[['c', 'a']])
+    assert list(ColumnsTest('missing').get_columns(['a']).columns) == ['a']
+    with pytest.raises(KeyError):
+        ColumnsTest('frame').get_columns(['d'])
+
+
+class SequenceTest(db.Sequence):
+    keys = ("Name",)
+    cacheSize = 100
+
+
+class UncachedSequenceTest(db.Sequence):
+    keys = ("Name",)
+    cacheSize = 0
+
+
+def test_sequence():
+    hits = SequenceTest('hits')
+    assert hits.incr() == 1
+    assert hits.incr(5) == 6
+    assert hits.get() == 6
+    assert asyncio.run(hits.aget()) == 6
+
+    # Reading a counter which doesn't exist doesn't create it
+    assert SequenceTest('unknown').get() is None
+    assert not SequenceTest.has_key(('unknown',))
+
+    ids = []
+
+    def takeIds():
+        for i in range(250):
+            ids.append(SequenceTest('ids').next_id())
+
+    threads = [threading.Thread(target=takeIds) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(ids) == list(range(1000))
+
+    assert dict(SequenceTest.iter_items()) == {('hits',): 6, ('ids',): 1000}
+
+    txn = db.getEnvTxn()
+    with pytest.raises(ValueError):
+        hits.incr(txn=txn)
+    assert UncachedSequenceTest('a').incr(2, txn=txn) == 2
+    txn.commit()
+    assert UncachedSequenceTest('a').incr() == 3
+
+    with pytest.raises(TypeError):
+        hits.put(1)
+
+
+class QueueTest(db.QueueResource):
+    keys = ("Recno",)
+    recordLength = 64
+
+
+def test_queue():
+    assert QueueTest.pop() is None
+    assert QueueTest.push('a') == 1
+    assert QueueTest.push_many(['b', 'c']) == [2, 3]
+    assert QueueTest.length() == 3
+    assert QueueTest('2').get() == 'b'
+    assert repr(QueueTest('2')) == 'QueueTest("(\'2\',)")'
+    assert QueueTest.peek() == 'a'
+
+    with pytest.raises(ValueError):
+        QueueTest.push('x' * 100)
+
+    assert QueueTest.pop() == 'a'
+    assert QueueTest.pop() == 'b'
+    assert QueueTest.pop(blocking=True, timeout=5) == 'c'
+    assert QueueTest.pop(blocking=True, timeout=0.1) is None
+
+    pusher = threading.Timer(0.2, QueueTest.push, args=('d',))
+    pusher.start()
+    assert QueueTest.pop(blocking=True, timeout=10) == 'd'
+    pusher.join()
+
+    # Longer than the largest lock timeout, which is then waited in pieces
+    QueueTest.push('f')
+    assert QueueTest.pop(blocking=True, timeout=24 * 60 * 60) == 'f'
+
+    QueueTest.push('e')
+    txn = db.getEnvTxn()
+    assert QueueTest.pop(txn=txn) == 'e'
+    txn.abort()
+    assert QueueTest.pop() == 'e'
+
+
+class HashTest(db.Resource):
+    keys = ("First", "Second")
+    keyCodec = db.TupleKeyCodec
+    DBTYPE = berkeleydb.db.DB_HASH
+    hashFillFactor = 40
+    hashSize = 1000
+
+
+class ConvertTest(db.Resource):
+    keys = ("First",)
+    btreeMinKey = 4
+
+
+def test_access_methods():
+    hashStats = HashTest.db.stat()
+    assert hashStats['ffactor'] == 40
+
+    for first in ('a', 'b'):
+        for second in ('1', '2'):
+            HashTest(first, second).put(first + second)
+    assert HashTest('a', '2').get() == 'a2'
+    assert sorted(HashTest.keysWhichMatch('a')) == [('a', '1'), ('a', '2')]
+    assert HashTest.count_prefix('b') == 2
+    assert len(list(HashTest.iter_items(prefix=('b',)))) == 2
+
+    assert ConvertTest.db.stat()['minkey'] == 4
+    for key in range(50):
+        ConvertTest(key).put(key)
+
+    ConvertTest.DBTYPE = berkeleydb.db.DB_HASH
+    assert db.convertAccessMethod(ConvertTest, chunk=7) == 50
+    assert ConvertTest.db.get_type() == berkeleydb.db.DB_HASH
+    assert ConvertTest('10').get() == 10
+    assert ConvertTest.length() == 50
+
+
 db.open_dbs()
 
 